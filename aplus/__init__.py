@@ -1,11 +1,185 @@
-from threading import Event, RLock
+from threading import Condition, Event, Lock, RLock, Thread, get_ident
+import array
+import contextvars
+import functools
+import heapq
+import itertools
+import time
+import types
+import weakref
+
+
+# Factories for the synchronization primitives created by every
+# promise and latch.  These are swapped for cooperative versions
+# by use_gevent().
+_newLock = RLock
+_newEvent = Event
+
+
+class _NoLock:
+    """
+    A lock that does nothing.  Greenlets only switch at blocking
+    calls, none of which happen while a promise holds its lock, so
+    in gevent mode no real locking is required.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_noLock = _NoLock()
+
+# Serializes changes to which promise is following which, so that
+# followers can be re-targeted as adoption chains collapse.
+_adoptLock = RLock()
+
+# The active aplus.profiling.ChainProfiler, if any.
+_profiler = None
+
+# The active aplus.tracing.TraceRecorder, if any.
+_tracer = None
+
+# The active aplus.leaks.LeakTracker, if any.
+_leaks = None
+
+
+def _dispatchNow(promise, handlers, arg):
+    """
+    Invoke each of the handlers with the given argument in the
+    calling thread, ignoring any errors they raise.
+    """
+    for handler in handlers:
+        try:
+            handler(arg)
+        except Exception:
+            # Ignore errors in handlers
+            pass
+
+
+# In gevent mode, the thread running the hub and the hub's loop.
+_hubThread = None
+_hubLoop = None
+
+
+def _onForeignThread():
+    """
+    Whether, in gevent mode, the calling thread is not the hub's
+    thread, so promises mustn't be touched from it directly.
+    """
+    return get_ident() != _hubThread
+
+
+def _dispatchOnHub(promise, handlers, arg):
+    """
+    Invoke the handlers in a new greenlet, rather than in whoever
+    settled the promise, so that they may wait cooperatively.  When
+    called from another thread, the greenlet is started by the hub's
+    loop.
+    """
+    import gevent
+
+    if _onForeignThread():
+        _hubLoop.run_callback_threadsafe(gevent.spawn, _dispatchNow, promise, handlers, arg)
+    else:
+        gevent.spawn(_dispatchNow, promise, handlers, arg)
+
+
+class _TimerEntry:
+    """A callback scheduled on the shared timer, which may be cancelled."""
+
+    __slots__ = ("when", "seq", "f", "args")
+
+    def __init__(self, when, seq, f, args):
+        self.when = when
+        self.seq = seq
+        self.f = f
+        self.args = args
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        self.f = None
+        self.args = None
+
+    def run(self):
+        f, args = self.f, self.args
+        if f is not None:
+            self.cancel()
+            try:
+                f(*args)
+            except Exception:
+                # Ignore errors in timer callbacks
+                pass
+
+
+class _Timer:
+    """
+    Runs callbacks at given (monotonic) times from a single daemon
+    thread, shared by everything in the package that needs a delay,
+    rather than sleeping a thread per delay.  In gevent mode the
+    callbacks are scheduled on the hub instead.
+    """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._heap = []
+        self._seq = itertools.count()
+        self._thread = None
+
+    def schedule(self, delay, f, *args):
+        """
+        Call f with the given arguments after delay seconds.  Returns
+        an entry whose cancel method prevents the call.
+        """
+        entry = _TimerEntry(time.monotonic() + delay, next(self._seq), f, args)
+
+        if Promise._deferred:
+            import gevent
+
+            gevent.spawn_later(max(delay, 0), entry.run)
+            return entry
+
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="aplus-timer")
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._cond.notify()
+
+        return entry
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+
+                entry = self._heap[0]
+                delay = entry.when - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                heapq.heappop(self._heap)
+
+            entry.run()
+
+
+_timer = _Timer()
 
 
 class CountdownLatch:
     def __init__(self, count):
         assert count >= 0
 
-        self._lock = RLock()
+        self._lock = _newLock()
         self._count = count
 
     def dec(self):
@@ -37,6 +211,14 @@ class Promise:
     REJECTED = 0
     FULFILLED = 1
 
+    # How callbacks are delivered once the promise is settled and
+    # whether that delivery happens later rather than immediately.
+    # Both are replaced by use_gevent().
+    _dispatch = _dispatchNow
+    _deferred = False
+    # Whether this is a promise created by Promise.lazy.
+    _lazy = False
+
     def __init__(self):
         """
         Initialize the Promise into a pending state.
@@ -44,10 +226,21 @@ class Promise:
         self._state = self.PENDING
         self._value = None
         self._reason = None
-        self._cb_lock = RLock()
+        self._cb_lock = _newLock()
         self._callbacks = []
         self._errbacks = []
-        self._event = Event()
+        self._event = _newEvent()
+        # The promise this one has adopted (if any) and weak references
+        # to the promises that have adopted this one.
+        self._target = None
+        self._followers = None
+        # Listeners registered with on_progress
+        self._progress = None
+
+        if _tracer is not None:
+            _tracer._created(self)
+        if _leaks is not None:
+            _leaks._created(self)
 
     @staticmethod
     def fulfilled(x):
@@ -61,6 +254,19 @@ class Promise:
         p.reject(reason)
         return p
 
+    @staticmethod
+    def lazy(fn):
+        """
+        Create a promise for the result of fn which only calls fn once
+        the promise is consumed, i.e. on the first call to then, done,
+        get, wait (or any of their variants), or when another promise
+        adopts it.  fn is called in the consuming thread and may return
+        a value or a promise, e.g. lambda: spawn(work).  Inspecting the
+        state of the promise does not count as consuming it.
+        """
+        assert _isFunction(fn)
+        return _LazyPromise(fn)
+
     def fulfill(self, x):
         """
         Fulfill the promise with a given value.
@@ -68,23 +274,139 @@ class Promise:
 
         if self is x:
             raise TypeError("Cannot resolve promise with itself.")
-        elif _isPromise(x):
+
+        if self._deferred and _onForeignThread():
+            _hubLoop.run_callback_threadsafe(self.fulfill, x)
+            return
+
+        kind = _thenableKinds.get(type(x))
+        if kind is None:
+            kind = _thenableKind(x)
+
+        if kind == _NOT_THENABLE:
+            self._fulfill(x)
+        elif kind == _PROMISE:
+            self._adopt(x)
+        else:
             try:
-                _promisify(x).done(self.fulfill, self.reject)
+                _promisify(x, kind).done(self.fulfill, self.reject)
             except Exception as e:
                 self.reject(e)
+
+    def _adopt(self, other):
+        """
+        Make this promise follow the state of another promise.
+
+        Rather than registering callbacks on the other promise (which,
+        for recursive loops, builds an ever growing chain of promises
+        each waiting on the next), our callbacks are moved onto the
+        innermost pending promise and we become one of its followers.
+        Any promises following us are moved along with them, so a chain
+        of adoptions always collapses to a single hop.
+        """
+        if other._lazy:
+            other._force()
+
+        with _adoptLock:
+            root = other._target or other
+            if root is self:
+                cycle = True
+            else:
+                cycle = False
+                with self._cb_lock:
+                    if self._state != Promise.PENDING or self._target is not None:
+                        return
+
+                    with root._cb_lock:
+                        if root._state == Promise.PENDING:
+                            root._callbacks.extend(self._callbacks)
+                            root._errbacks.extend(self._errbacks)
+                            self._callbacks = []
+                            self._errbacks = []
+
+                            followers = [weakref.ref(self)]
+                            if self._followers:
+                                followers.extend(self._followers)
+                                self._followers = None
+                            if root._followers:
+                                followers.extend(root._followers)
+
+                            # Drop the followers which have been garbage
+                            # collected and point the rest at the new root.
+                            live = []
+                            for ref in followers:
+                                follower = ref()
+                                if follower is not None:
+                                    follower._target = root
+                                    live.append(ref)
+                            root._followers = live
+                            return
+
+        if cycle:
+            self.reject(TypeError("Chaining cycle detected in promise adoption."))
+        elif root._state == Promise.FULFILLED:
+            self._fulfill(root._value)
         else:
-            self._fulfill(x)
+            self.reject(root._reason)
+
+    def _settleFollowers(self, followers):
+        """
+        Copy the (now final) state of this promise into each of the
+        promises that were following it.  Their callbacks have already
+        been moved onto this promise.
+        """
+        for ref in followers:
+            follower = ref()
+            if follower is None:
+                continue
+
+            with follower._cb_lock:
+                if follower._state != Promise.PENDING:
+                    continue
+
+                follower._value = self._value
+                follower._reason = self._reason
+                follower._state = self._state
+                if _profiler is not None:
+                    follower._settledAt = time.monotonic()
+                if _tracer is not None:
+                    _tracer._settled(follower, cause=self)
+                if _leaks is not None:
+                    _leaks._settled(follower)
+                follower._callbacks = None
+                follower._errbacks = None
+                follower._target = None
+
+                # Notify all waiting
+                follower._event.set()
 
     def _fulfill(self, value):
+        callbacks = self._setFulfilled(value)
+        if callbacks is not None:
+            self._dispatch(callbacks, value)
+
+    def _setFulfilled(self, value):
+        """
+        Move the promise into the fulfilled state and return the
+        callbacks which now need to be invoked, or None if the promise
+        was no longer pending.
+        """
         with self._cb_lock:
-            if self._state != Promise.PENDING:
-                return
+            if self._state != Promise.PENDING or self._target is not None:
+                return None
 
             self._value = value
             self._state = self.FULFILLED
+            if _profiler is not None:
+                self._settledAt = time.monotonic()
+            if _tracer is not None:
+                _tracer._settled(self)
+            if _leaks is not None:
+                _leaks._settled(self)
 
             callbacks = self._callbacks
+            progress = self._progress
+            self._progress = None
             # We will never call these callbacks again, so allow
             # them to be garbage collected.  This is important since
             # they probably include closures which are binding variables
@@ -93,15 +415,20 @@ class Promise:
             # Prevent future appending
             self._callbacks = None
 
+            followers = self._followers
+            self._followers = None
+
             # Notify all waiting
             self._event.set()
 
-        for callback in callbacks:
-            try:
-                callback(value)
-            except Exception:
-                # Ignore errors in callbacks
-                pass
+        # Followers are settled before any callbacks run, since those
+        # callbacks may have been registered on (and inspect) a follower.
+        if followers:
+            self._settleFollowers(followers)
+        if progress:
+            _flushProgress(progress)
+
+        return callbacks
 
     def reject(self, reason):
         """
@@ -109,14 +436,36 @@ class Promise:
         """
         assert isinstance(reason, Exception)
 
+        if self._deferred and _onForeignThread():
+            _hubLoop.run_callback_threadsafe(self.reject, reason)
+            return
+
+        errbacks = self._setRejected(reason)
+        if errbacks is not None:
+            self._dispatch(errbacks, reason)
+
+    def _setRejected(self, reason):
+        """
+        Move the promise into the rejected state and return the
+        errbacks which now need to be invoked, or None if the promise
+        was no longer pending.
+        """
         with self._cb_lock:
-            if self._state != Promise.PENDING:
-                return
+            if self._state != Promise.PENDING or self._target is not None:
+                return None
 
             self._reason = reason
             self._state = self.REJECTED
+            if _profiler is not None:
+                self._settledAt = time.monotonic()
+            if _tracer is not None:
+                _tracer._settled(self)
+            if _leaks is not None:
+                _leaks._settled(self)
 
             errbacks = self._errbacks
+            progress = self._progress
+            self._progress = None
             # We will never call these errbacks again, so allow
             # them to be garbage collected.  This is important since
             # they probably include closures which are binding variables
@@ -125,15 +474,18 @@ class Promise:
             # Prevent future appending
             self._errbacks = None
 
+            followers = self._followers
+            self._followers = None
+
             # Notify all waiting
             self._event.set()
 
-        for errback in errbacks:
-            try:
-                errback(reason)
-            except Exception:
-                # Ignore errors in errback
-                pass
+        if followers:
+            self._settleFollowers(followers)
+        if progress:
+            _flushProgress(progress)
+
+        return errbacks
 
     @property
     def isPending(self):
@@ -187,14 +539,25 @@ class Promise:
 
         with self._cb_lock:
             if self._state == self.PENDING:
-                self._callbacks.append(f)
-                return
+                target = self._target
+                if target is None:
+                    self._callbacks.append(f)
+                    return
+
+        # A promise which has adopted another one keeps no callbacks
+        # of its own, they are registered directly on its target.
+        if self._state == self.PENDING:
+            target.addCallback(f)
+            return
 
         # This is a correct performance optimization in case of concurrency.
         # State can never change once it is not PENDING anymore and is thus safe to read
         # without acquiring the lock.
         if self._state == self.FULFILLED:
-            f(self._value)
+            if self._deferred:
+                self._dispatch([f], self._value)
+            else:
+                f(self._value)
         else:
             pass
 
@@ -209,30 +572,115 @@ class Promise:
 
         with self._cb_lock:
             if self._state == self.PENDING:
-                self._errbacks.append(f)
-                return
+                target = self._target
+                if target is None:
+                    self._errbacks.append(f)
+                    return
+
+        # A promise which has adopted another one keeps no callbacks
+        # of its own, they are registered directly on its target.
+        if self._state == self.PENDING:
+            target.addErrback(f)
+            return
 
         # This is a correct performance optimization in case of concurrency.
         # State can never change once it is not PENDING anymore and is thus safe to read
         # without acquiring the lock.
         if self._state == self.REJECTED:
-            f(self._reason)
+            if self._deferred:
+                self._dispatch([f], self._reason)
+            else:
+                f(self._reason)
         else:
             pass
 
-    def done(self, success=None, failure=None):
+    def notify(self, progress):
+        """
+        Report progress towards settling this promise to the listeners
+        registered with on_progress.  Ignored once the promise has been
+        settled.
+        """
+        listeners = self._progress
+        if listeners is None or self._state != self.PENDING:
+            return
+
+        for listener in listeners:
+            listener.offer(progress)
+
+    def on_progress(self, f, min_interval=0.0):
+        """
+        Register a function to be called with the values passed to
+        notify.  Calls are coalesced so that f is invoked at most once
+        every min_interval seconds, with the latest value; any value
+        still held back is delivered before the promise's callbacks
+        run when it is settled.  The function is called from whichever
+        thread calls notify, or from the timer thread.
+        """
+        assert _isFunction(f)
+
+        with self._cb_lock:
+            if self._state == self.PENDING:
+                if self._progress is None:
+                    self._progress = []
+                self._progress.append(_ProgressListener(f, min_interval))
+
+    def done(self, success=None, failure=None, on=None):
         """
         This method takes two optional arguments.  The first argument
         is used if the "self promise" is fulfilled and the other is
         used if the "self promise" is rejected. In contrast to then,
         the return value of these callback is ignored and nothing is
         returned.
+
+        If on is given (an aplus.dispatch.Dispatcher), the callbacks
+        are queued on it rather than run by the thread settling the
+        promise.
+        """
+        callbacks = []
+        errbacks = []
+
+        if success is not None:
+            assert _isFunction(success)
+            if on is not None:
+                success = functools.partial(on.call_soon, success)
+            callbacks.append(success)
+        if failure is not None:
+            assert _isFunction(failure)
+            if on is not None:
+                failure = functools.partial(on.call_soon, failure)
+            errbacks.append(failure)
+
+        self._addAll(callbacks, errbacks)
+
+    def _addAll(self, callbacks, errbacks):
+        """
+        Register lists of callbacks and errbacks while acquiring the
+        lock only once.
         """
         with self._cb_lock:
-            if success is not None:
-                self.addCallback(success)
-            if failure is not None:
-                self.addErrback(failure)
+            if self._state == self.PENDING:
+                target = self._target
+                if target is None:
+                    self._callbacks.extend(callbacks)
+                    self._errbacks.extend(errbacks)
+                    return
+
+        if self._state == self.PENDING:
+            target._addAll(callbacks, errbacks)
+            return
+
+        # As in addCallback and addErrback, the state can no longer
+        # change and is safe to read without the lock.
+        if self._state == self.FULFILLED:
+            handlers, arg = callbacks, self._value
+        else:
+            handlers, arg = errbacks, self._reason
+
+        if self._deferred:
+            self._dispatch(handlers, arg)
+        else:
+            for f in handlers:
+                f(arg)
 
     def done_all(self, *handlers):
         """
@@ -243,20 +691,30 @@ class Promise:
         elif len(handlers) == 1 and isinstance(handlers[0], list):
             handlers = handlers[0]
 
+        callbacks = []
+        errbacks = []
+
         for handler in handlers:
             if isinstance(handler, tuple):
                 s, f = handler
-
-                self.done(s, f)
             elif isinstance(handler, dict):
                 s = handler.get('success')
                 f = handler.get('failure')
-
-                self.done(s, f)
             else:
-                self.done(success=handler)
+                s, f = handler, None
+
+            if s is not None:
+                assert _isFunction(s)
+                callbacks.append(s)
+            if f is not None:
+                assert _isFunction(f)
+                errbacks.append(f)
+
+        # All the handlers are registered under a single acquisition
+        # of the lock.
+        self._addAll(callbacks, errbacks)
 
-    def then(self, success=None, failure=None):
+    def then(self, success=None, failure=None, on=None):
         """
         This method takes two optional arguments.  The first argument
         is used if the "self promise" is fulfilled and the other is
@@ -281,12 +739,32 @@ class Promise:
             when the "self promise" is either fulfilled or rejected,
             respectively.
 
+        If on is given (an aplus.dispatch.Dispatcher), the arguments
+        are called, and the returned promise settled, by the thread
+        which runs the dispatcher's pending callbacks rather than by
+        the thread settling the "self promise".
+
         :type success: (object) -> object
         :type failure: (object) -> object
         :rtype : Promise
         """
+        ret, callAndFulfill, callAndReject = self._chain(success, failure)
+        if on is not None:
+            callAndFulfill = functools.partial(on.call_soon, callAndFulfill)
+            callAndReject = functools.partial(on.call_soon, callAndReject)
+        self._addAll([callAndFulfill], [callAndReject])
+        return ret
+
+    def _chain(self, success, failure):
+        """
+        Create the promise returned by then, together with the
+        callback and errback which settle it.
+        """
         ret = Promise()
 
+        if _profiler is not None:
+            success, failure = _profiler._wrap(self, ret, success, failure)
+
         def callAndFulfill(v):
             """
             A callback to be invoked if the "self promise"
@@ -313,9 +791,11 @@ class Promise:
             except Exception as e:
                 ret.reject(e)
 
-        self.done(callAndFulfill, callAndReject)
+        if _tracer is not None:
+            callAndFulfill = _tracer._wrap(self, ret, success, callAndFulfill)
+            callAndReject = _tracer._wrap(self, ret, failure, callAndReject)
 
-        return ret
+        return ret, callAndFulfill, callAndReject
 
     def then_all(self, *handlers):
         """
@@ -332,23 +812,76 @@ class Promise:
             handlers = handlers[0]
 
         promises = []
+        callbacks = []
+        errbacks = []
 
         for handler in handlers:
             if isinstance(handler, tuple):
                 s, f = handler
-
-                promises.append(self.then(s, f))
             elif isinstance(handler, dict):
                 s = handler.get('success')
                 f = handler.get('failure')
-
-                promises.append(self.then(s, f))
             else:
-                promises.append(self.then(success=handler))
+                s, f = handler, None
+
+            ret, callAndFulfill, callAndReject = self._chain(s, f)
+            promises.append(ret)
+            callbacks.append(callAndFulfill)
+            errbacks.append(callAndReject)
+
+        # All the handlers are registered under a single acquisition
+        # of the lock.
+        self._addAll(callbacks, errbacks)
 
         return promises
 
 
+class _LazyPromise(Promise):
+    """
+    A promise which calls a function to produce its value the first
+    time it is consumed.  See Promise.lazy.
+    """
+
+    _lazy = True
+
+    def __init__(self, fn):
+        Promise.__init__(self)
+        self._thunk = fn
+
+    def _force(self):
+        """
+        Call the function, unless that has already been done or the
+        promise has been settled by other means.
+        """
+        with self._cb_lock:
+            thunk = self._thunk
+            self._thunk = None
+            if self._state != Promise.PENDING:
+                thunk = None
+
+        if thunk is not None:
+            try:
+                self.fulfill(thunk())
+            except Exception as e:
+                self.reject(e)
+
+    def wait(self, timeout=None):
+        self._force()
+        Promise.wait(self, timeout)
+
+    def addCallback(self, f):
+        self._force()
+        Promise.addCallback(self, f)
+
+    def addErrback(self, f):
+        self._force()
+        Promise.addErrback(self, f)
+
+    def _addAll(self, callbacks, errbacks):
+        self._force()
+        Promise._addAll(self, callbacks, errbacks)
+
+
 def _isFunction(v):
     """
     A utility function to determine if the specified
@@ -357,24 +890,85 @@ def _isFunction(v):
     return v is not None and hasattr(v, "__call__")
 
 
+# The ways in which a value can be adopted by a promise.
+_NOT_THENABLE = 0
+_PROMISE = 1
+_HAS_DONE = 2
+_HAS_THEN = 3
+
+# A cache of how instances of a given type are adopted, keyed by type.
+# Common builtin types are seeded so they never need to be probed.
+_thenableKinds = dict.fromkeys(
+    (type(None), bool, int, float, complex, str, bytes, bytearray,
+     tuple, list, dict, set, frozenset),
+    _NOT_THENABLE)
+_thenableKinds[Promise] = _PROMISE
+_thenableKinds[_LazyPromise] = _PROMISE
+
+# Guard against unbounded growth when types are created dynamically.
+_MAX_THENABLE_KINDS = 1024
+
+
+def _thenableKind(obj):
+    """
+    Classify the specified object as a Promise, an object with a
+    "done" method, an object with a "then" method or none of these.
+
+    The object itself is probed, since "done" and "then" may be
+    instance attributes.  The result is only cached by type when that
+    can't be the case: the type defines neither attribute, its
+    instances have no __dict__ and it doesn't compute attributes
+    dynamically (via __getattr__).  Common builtin types are always
+    found in the cache.
+    """
+    t = type(obj)
+    kind = _thenableKinds.get(t)
+    if kind is not None:
+        return kind
+
+    if isinstance(obj, Promise):
+        kind = _PROMISE
+    elif _isFunction(getattr(obj, "done", None)):
+        kind = _HAS_DONE
+    elif _isFunction(getattr(obj, "then", None)):
+        kind = _HAS_THEN
+    else:
+        kind = _NOT_THENABLE
+
+    cacheable = (kind == _PROMISE or
+                 (kind == _NOT_THENABLE and
+                  not hasattr(obj, "__dict__") and
+                  not hasattr(t, "__getattr__")))
+
+    if cacheable:
+        if len(_thenableKinds) >= _MAX_THENABLE_KINDS:
+            _thenableKinds.clear()
+            _thenableKinds[Promise] = _PROMISE
+            _thenableKinds[_LazyPromise] = _PROMISE
+        _thenableKinds[t] = kind
+
+    return kind
+
+
 def _isPromise(obj):
     """
     A utility function to determine if the specified
     object is a promise using "duck typing".
     """
-    return isinstance(obj, Promise) or (
-        hasattr(obj, "done") and _isFunction(getattr(obj, "done"))) or (
-        hasattr(obj, "then") and _isFunction(getattr(obj, "then")))
+    return _thenableKind(obj) != _NOT_THENABLE
 
 
-def _promisify(obj):
-    if isinstance(obj, Promise):
+def _promisify(obj, kind=None):
+    if kind is None:
+        kind = _thenableKind(obj)
+
+    if kind == _PROMISE:
         return obj
-    elif hasattr(obj, "done") and _isFunction(getattr(obj, "done")):
+    elif kind == _HAS_DONE:
         p = Promise()
         obj.done(p.fulfill, p.reject)
         return p
-    elif hasattr(obj, "then") and _isFunction(getattr(obj, "then")):
+    elif kind == _HAS_THEN:
         p = Promise()
         obj.then(p.fulfill, p.reject)
         return p
@@ -382,12 +976,83 @@ def _promisify(obj):
         raise TypeError("Object is not a Promise like object.")
 
 
+def fulfill_many(pairs):
+    """
+    Fulfill many promises at once, given an iterable of (promise, value)
+    pairs.  The promises fulfilled with plain values are all settled
+    before any of their callbacks are invoked, and the callbacks are
+    then invoked in a single pass.  Values which are themselves
+    promises (or thenables) are adopted just as they would be by
+    fulfill, so their callbacks may run as soon as they are adopted.
+    The pairs are checked before any promise is settled.
+    """
+    pairs = list(pairs)
+    for p, value in pairs:
+        if p is value:
+            raise TypeError("Cannot resolve promise with itself.")
+
+    if Promise._deferred and _onForeignThread():
+        _hubLoop.run_callback_threadsafe(fulfill_many, pairs)
+        return
+
+    ready = []
+
+    try:
+        for p, value in pairs:
+            kind = _thenableKinds.get(type(value))
+            if kind is None:
+                kind = _thenableKind(value)
+
+            if kind != _NOT_THENABLE:
+                p.fulfill(value)
+                continue
+
+            callbacks = p._setFulfilled(value)
+            if callbacks:
+                ready.append((p, callbacks, value))
+    finally:
+        # The promises already settled get their callbacks even if a
+        # later one failed.
+        for p, callbacks, value in ready:
+            p._dispatch(callbacks, value)
+
+
+def reject_many(pairs):
+    """
+    Reject many promises at once, given an iterable of (promise, reason)
+    pairs.  All of the promises are settled before any of their errbacks
+    are invoked, and the errbacks are then invoked in a single pass.
+    The pairs are checked before any promise is settled.
+    """
+    pairs = list(pairs)
+    for p, reason in pairs:
+        assert isinstance(reason, Exception)
+
+    if Promise._deferred and _onForeignThread():
+        _hubLoop.run_callback_threadsafe(reject_many, pairs)
+        return
+
+    ready = []
+
+    try:
+        for p, reason in pairs:
+            errbacks = p._setRejected(reason)
+            if errbacks:
+                ready.append((p, errbacks, reason))
+    finally:
+        for p, errbacks, reason in ready:
+            p._dispatch(errbacks, reason)
+
+
 def listPromise(*promises):
     """
     A special function that takes a bunch of promises
     and turns them into a promise for a vector of values.
     In other words, this turns an list of promises for values
     into a promise for a list of values.
+
+    If any of the promises is lazy (see Promise.lazy) the result is
+    lazy too, so none of them is forced until the result is consumed.
     """
     if len(promises) == 1 and isinstance(promises[0], list):
         promises = promises[0]
@@ -395,6 +1060,24 @@ def listPromise(*promises):
     if len(promises) == 0:
         return Promise.fulfilled([])
 
+    if _anyLazy(promises):
+        return Promise.lazy(lambda: _gatherList(promises))
+
+    return _gatherList(promises)
+
+
+def _anyLazy(promises):
+    """
+    Determine whether any of the given values is an unforced lazy
+    promise.
+    """
+    for p in promises:
+        if getattr(p, "_lazy", False) and p._thunk is not None:
+            return True
+    return False
+
+
+def _gatherList(promises):
     ret = Promise()
     counter = CountdownLatch(len(promises))
 
@@ -406,76 +1089,542 @@ def listPromise(*promises):
     for p in promises:
         assert _isPromise(p)
 
-        _promisify(p).done(handleSuccess, ret.reject)
+        p = _promisify(p)
+        if _tracer is not None:
+            p.done(_tracer._wrap(p, ret, "listPromise", handleSuccess),
+                   _tracer._wrap(p, ret, "listPromise", ret.reject))
+        else:
+            p.done(handleSuccess, ret.reject)
 
     return ret
 
 
-def dictPromise(m):
+# Typecodes for array.array, used by gather_array when NumPy is not
+# available.
+_ARRAY_TYPECODES = {
+    float: "d", int: "q", bool: "b",
+    "float64": "d", "float32": "f", "double": "d", "float": "d",
+    "int64": "q", "int32": "i", "int16": "h", "int8": "b",
+    "uint64": "Q", "uint32": "I", "uint16": "H", "uint8": "B",
+}
+
+
+def _newArray(size, dtype):
+    """
+    Allocate a zeroed NumPy array of the given size and dtype, falling
+    back to an array.array when NumPy is not installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        typecode = _ARRAY_TYPECODES.get(dtype, dtype)
+        return array.array(typecode, [0]) * size
+
+    return numpy.zeros(size, dtype=dtype)
+
+
+def gather_array(promises, dtype=float):
+    """
+    A variant of listPromise for numeric results.  Returns a promise
+    for a NumPy array (or an array.array, if NumPy is not installed) of
+    the given dtype.  The array is allocated up front and each value is
+    written into it at its index as soon as its promise is fulfilled,
+    so no intermediate list of boxed values is built.  The promise is
+    rejected if any of the promises is, or if a value can't be stored
+    in the array.
+    """
+    promises = list(promises)
+    buf = _newArray(len(promises), dtype)
+
+    if len(promises) == 0:
+        return Promise.fulfilled(buf)
+
+    ret = Promise()
+    counter = CountdownLatch(len(promises))
+
+    def store(i, v):
+        try:
+            buf[i] = v
+        except Exception as e:
+            ret.reject(e)
+            return
+
+        if counter.dec() == 0:
+            ret.fulfill(buf)
+
+    for i, p in enumerate(promises):
+        assert _isPromise(p)
+
+        _promisify(p).done(functools.partial(store, i), ret.reject)
+
+    return ret
+
+
+def dictPromise(m, on_item=None):
     """
     A special function that takes a dictionary of promises
     and turns them into a promise for a dictionary of values.
     In other words, this turns an dictionary of promises for values
     into a promise for a dictionary of values.
+
+    Each value is recorded as soon as its promise is fulfilled, and if
+    on_item is given it is called with the key and value at that point,
+    so partial results can be consumed as they arrive.  If on_item
+    raises, the returned promise is rejected.
+
+    As with listPromise, if any of the promises is lazy the result is
+    lazy too.
     """
     if len(m) == 0:
         return Promise.fulfilled({})
 
+    if _anyLazy(m.values()):
+        return Promise.lazy(lambda: _gatherDict(m, on_item))
+
+    return _gatherDict(m, on_item)
+
+
+def _gatherDict(m, on_item):
     ret = Promise()
     counter = CountdownLatch(len(m))
+    # Pre-populating the keys keeps them in the order of the input
+    # mapping, rather than the order in which values arrive.
+    value = dict.fromkeys(m)
 
-    def handleSuccess(_):
-        if counter.dec() == 0:
-            value = {}
+    def handleSuccess(k, v):
+        value[k] = v
 
-            for k in m:
-                value[k] = m[k].value
+        if on_item is not None:
+            try:
+                on_item(k, v)
+            except Exception as e:
+                ret.reject(e)
+                return
 
+        if counter.dec() == 0:
             ret.fulfill(value)
 
-    for p in m.values():
+    for k, p in m.items():
+        kind = _thenableKind(p)
+        assert kind != _NOT_THENABLE
+
+        _promisify(p, kind).done(functools.partial(handleSuccess, k), ret.reject)
+
+    return ret
+
+
+class _Reducer:
+    """
+    Folds the values of a stream of promises into an accumulator as
+    they are fulfilled.  Calls to the function are serialized by a
+    lock, and each value is dropped as soon as it has been folded in
+    (or, when the order matters, as soon as all values before it have
+    been).
+    """
+
+    def __init__(self, fn, initial, ordered, promise):
+        self._fn = fn
+        self._acc = initial
+        self._promise = promise
+        self._lock = _newLock()
+        # The promises registered but not yet settled, plus one which
+        # is held until all of them have been registered.
+        self._outstanding = 1
+        self._next = 0
+        self._early = {} if ordered else None
+
+    def add(self, i, p):
+        with self._lock:
+            self._outstanding += 1
+
+        _promisify(p).done(functools.partial(self._fold, i), self._promise.reject)
+
+    def _fold(self, i, v):
+        with self._lock:
+            if self._promise._state != Promise.PENDING:
+                return
+
+            try:
+                if self._early is None:
+                    self._acc = self._fn(self._acc, v)
+                else:
+                    # Values which arrive early wait for the ones
+                    # before them.
+                    early = self._early
+                    early[i] = v
+                    while self._next in early:
+                        self._acc = self._fn(self._acc, early.pop(self._next))
+                        self._next += 1
+            except Exception as e:
+                self._outstanding = -1
+                failure = e
+            else:
+                failure = None
+                self._outstanding -= 1
+            finished = self._outstanding == 0
+
+        if failure is not None:
+            self._promise.reject(failure)
+        elif finished:
+            self._promise.fulfill(self._acc)
+
+    def finish(self):
+        """
+        Indicate that all of the promises have been registered.
+        """
+        with self._lock:
+            self._outstanding -= 1
+            finished = self._outstanding == 0
+
+        if finished:
+            self._promise.fulfill(self._acc)
+
+
+def reduce(fn, promises, initial, ordered=False):
+    """
+    Fold the values of an iterable of promises into an accumulator,
+    calling fn(accumulator, value) for each value, and return a promise
+    for the final accumulator.  Unlike listPromise, no list of values is
+    built: each value is folded in as soon as its promise is fulfilled,
+    in the order the promises settle, and then dropped.  If ordered is
+    true, values are folded in the order of the iterable instead, so
+    values which arrive early are held until the ones before them have
+    arrived.
+
+    The returned promise is rejected as soon as any of the promises is,
+    or if fn raises.  Calls to fn are never made concurrently.
+    """
+    ret = Promise()
+    reducer = _Reducer(fn, initial, ordered, ret)
+
+    for i, p in enumerate(promises):
         assert _isPromise(p)
 
-        _promisify(p).done(handleSuccess, ret.reject)
+        reducer.add(i, p)
 
+    reducer.finish()
     return ret
 
 
+class _InlineDriver:
+    """
+    Runs a generator which yields promises, resuming it with the value
+    of each promise (or throwing its reason into it) until it returns.
+
+    Promises which are already settled, and values which are not
+    promises at all, are fed straight back in by the loop in run, so
+    only genuinely pending promises cost a callback registration.  The
+    same pair of bound methods is registered for every step.
+    """
+
+    def __init__(self, gen, promise):
+        self._gen = gen
+        self._promise = promise
+        self._onFulfilled = self._resume
+        self._onRejected = self._throw
+
+    def _resume(self, value):
+        self.run(value, None)
+
+    def _throw(self, reason):
+        self.run(None, reason)
+
+    def run(self, value, reason):
+        gen = self._gen
+
+        while True:
+            try:
+                if reason is None:
+                    yielded = gen.send(value)
+                else:
+                    yielded = gen.throw(reason)
+            except StopIteration as e:
+                self._promise.fulfill(e.value)
+                return
+            except Exception as e:
+                self._promise.reject(e)
+                return
+
+            kind = _thenableKinds.get(type(yielded))
+            if kind is None:
+                kind = _thenableKind(yielded)
+
+            if kind == _NOT_THENABLE:
+                value, reason = yielded, None
+                continue
+
+            try:
+                p = _promisify(yielded, kind)
+            except Exception as e:
+                value, reason = None, e
+                continue
+
+            if p._state == Promise.FULFILLED:
+                value, reason = p._value, None
+            elif p._state == Promise.REJECTED:
+                value, reason = None, p._reason
+            else:
+                p.done(self._onFulfilled, self._onRejected)
+                return
+
+
+def inline(f):
+    """
+    A decorator for writing sequential asynchronous code as a
+    generator.  Each promise the generator yields is waited for
+    (without blocking) and its value is sent back in, or its reason
+    for rejection is raised at the yield.  Calling the decorated
+    function returns a promise for the generator's return value.
+
+    @inline
+    def total(a, b):
+        x = yield spawn(a)
+        y = yield spawn(b)
+        return x + y
+    """
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        ret = Promise()
+
+        try:
+            gen = f(*args, **kwargs)
+        except Exception as e:
+            ret.reject(e)
+            return ret
+
+        if isinstance(gen, types.GeneratorType):
+            _InlineDriver(gen, ret).run(None, None)
+        else:
+            ret.fulfill(gen)
+
+        return ret
+
+    return wrapper
+
+
+# Nothing has been held back for delivery to a progress listener
+_NO_PROGRESS = object()
+
+
+class _ProgressListener:
+    """
+    Delivers progress values to a function no more often than every
+    min_interval seconds.  Values arriving in between replace one
+    another, and the latest is delivered once the interval has passed.
+    """
+
+    def __init__(self, f, min_interval):
+        self._f = f
+        self._min_interval = min_interval
+        self._lock = Lock()
+        self._last = None
+        self._latest = _NO_PROGRESS
+        self._scheduled = None
+
+    def offer(self, value):
+        now = time.monotonic()
+
+        with self._lock:
+            if self._scheduled is not None:
+                self._latest = value
+                return
+
+            if self._last is not None and now - self._last < self._min_interval:
+                self._latest = value
+                self._scheduled = _timer.schedule(
+                    self._last + self._min_interval - now, self.flush)
+                return
+
+            self._last = now
+
+        self._deliver(value)
+
+    def flush(self):
+        with self._lock:
+            value = self._latest
+            self._latest = _NO_PROGRESS
+            if self._scheduled is not None:
+                self._scheduled.cancel()
+                self._scheduled = None
+
+            if value is _NO_PROGRESS:
+                return
+            self._last = time.monotonic()
+
+        self._deliver(value)
+
+    def _deliver(self, value):
+        try:
+            self._f(value)
+        except Exception:
+            # Ignore errors in progress listeners
+            pass
+
+
+def _flushProgress(listeners):
+    for listener in listeners:
+        listener.flush()
+
+
+# The promise for the spawned job running in the current thread (or
+# greenlet), which notify reports progress to.
+_currentPromise = contextvars.ContextVar("aplus_current_promise", default=None)
+
+
+def notify(progress):
+    """
+    Report progress from inside a function run by spawn.  This calls
+    notify on the promise that spawn returned for it, and is ignored
+    when called from anywhere else.
+    """
+    p = _currentPromise.get()
+    if p is not None:
+        p.notify(progress)
+
+
+class DeadlineExceeded(Exception):
+    """
+    The reason a spawned job is rejected when its deadline passed
+    before it could be started.
+    """
+    pass
+
+
+def _expired(p, deadline):
+    """
+    Reject the promise for a spawned job, and return True, if the
+    job's deadline (a time.monotonic() timestamp) has passed.
+    """
+    if deadline is None:
+        return False
+
+    late = time.monotonic() - deadline
+    if late <= 0:
+        return False
+
+    p.reject(DeadlineExceeded("Deadline passed %.3fs before the job could start" % late))
+    return True
+
+
 def _process(p, f):
+    if _tracer is not None:
+        f = _tracer._wrapSpawned(p, f)
+
+    token = _currentPromise.set(p)
     try:
         val = f()
         p.fulfill(val)
     except Exception as e:
         p.reject(e)
+    finally:
+        _currentPromise.reset(token)
+
+def use_gevent(enabled=True):
+    """
+    Switch promises into (or, with enabled=False, back out of) a
+    gevent-native mode.  In this mode promises use gevent events so
+    that wait and get block only the calling greenlet, skip OS-level
+    locking entirely, and deliver their callbacks in new greenlets
+    instead of invoking them from within fulfill or reject, so that
+    the callbacks may themselves wait.
+
+    The hub is the one belonging to the thread calling use_gevent.
+    Promises settled from other threads (executor workers, for
+    instance) are handed over to that hub's loop to be settled there.
+    Waiting on a promise is only possible from the hub's thread.  The
+    mode is process wide and should be selected before any promises
+    are created.
+    """
+    global _newLock, _newEvent, _hubThread, _hubLoop
+
+    if enabled:
+        import gevent
+        import gevent.event
+
+        _hubThread = get_ident()
+        _hubLoop = gevent.get_hub().loop
+        _newLock = lambda: _noLock
+        _newEvent = gevent.event.Event
+        Promise._dispatch = _dispatchOnHub
+        Promise._deferred = True
+    else:
+        _newLock = RLock
+        _newEvent = Event
+        Promise._dispatch = _dispatchNow
+        Promise._deferred = False
+
+
+from aplus.policies import (Policy, PolicyRejected, RateLimiter, Semaphore,
+                            _withPolicies)
+from aplus.executors import (KeyedExecutor, PriorityExecutor, PRIORITY_HIGH,
+                             PRIORITY_NORMAL, PRIORITY_LOW)
 
 try:
     import gevent
 
-    def spawn(f):
+    def _later(delay, f):
+        """
+        Call f after delay seconds, in a greenlet like spawned jobs.
+        Returns an object whose cancel method prevents the call.
+        """
+        entry = _TimerEntry(0, 0, f, ())
+        gevent.spawn_later(delay, entry.run)
+        return entry
+
+    def spawn(f, priority=PRIORITY_NORMAL, deadline=None, policy=None):
+        """
+        Run f in a new greenlet, returning a promise for its result.
+        Greenlets are not pooled, so there is no queue for the priority
+        to apply to and it is ignored.  If the greenlet starts after the
+        deadline (a time.monotonic() timestamp), f is not called and the
+        promise is rejected with DeadlineExceeded.  If a policy (or a
+        list of them) is given, the greenlet is only started once it
+        has been admitted.
+        """
+        if policy is not None:
+            return _withPolicies(policy, lambda: spawn(f, priority, deadline), _later)
+
         p = Promise()
-        g = gevent.spawn(lambda: _process(p, f))
+        if _tracer is not None:
+            _tracer._spawned(p, f)
+        g = gevent.spawn(lambda: _expired(p, deadline) or _process(p, f))
         return p
 except ImportError:
     pass
 
 if "spawn" not in dir():
-    try:
-        import concurrent.futures
-
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
-
-        def spawn(f):
-            p = Promise()
-            executor.submit(_process, p, f)
-            return p
-    except ImportError:
-        pass
-
-if "spawn" not in dir():
-    from threading import Thread
-
-    def spawn(f):
-        p = Promise()
-        t = Thread(target=_process, args=(p, f))
-        t.start()
-        return p
+    # Five workers run ordinary jobs and a sixth is kept for urgent
+    # ones, so a backlog of bulk work can't delay them.  Jobs queued
+    # for longer than a few seconds are started ahead of everything
+    # else, so none are starved.
+    executor = PriorityExecutor(max_workers=6, reserved={PRIORITY_HIGH: 1},
+                                max_wait=5.0)
+    _later = _timer.schedule
+
+    def spawn(f, priority=PRIORITY_NORMAL, deadline=None, policy=None):
+        """
+        Run f on the module's executor, returning a promise for its
+        result.  Jobs with a more urgent priority (PRIORITY_HIGH) are
+        started ahead of less urgent ones (PRIORITY_LOW), and can also
+        use a sixth worker which is kept free for them.  A job which
+        has been queued for more than five seconds is started first
+        regardless of its priority.  If no worker is free to start the
+        job before the deadline (a time.monotonic() timestamp), f is
+        not called and the promise is rejected with DeadlineExceeded.
+        If a policy (or a list of them) is given, the job is only
+        submitted to the executor once it has been admitted, so
+        waiting for admission doesn't tie up a worker.
+        """
+        return executor.submit(f, priority, deadline, policy)
+
+from aplus.pipeline import Pipeline
+from aplus.dispatch import Dispatcher
+from aplus.hedging import hedge
+from aplus.caching import disk_cache
+from aplus import io
+from aplus.io import run_process
+from aplus.profiling import ChainProfiler
+from aplus.tracing import TraceRecorder
+from aplus.leaks import LeakTracker
+from aplus.remote import RemoteError, RemotePromise, RemoteReceiver, RemoteSender
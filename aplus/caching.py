@@ -0,0 +1,365 @@
+"""
+A persistent cache for the results of expensive, deterministic jobs.
+
+disk_cache wraps a function so that calling it runs the function with
+spawn and returns a promise, as before, but values it has produced are
+kept in a file and served from there, even by a later process, without
+running it again.  The file is an append-only log of records, read
+through a memory map, and an index of the records in it is built when
+the file is opened.  Once the file grows beyond its limit it is
+rewritten keeping only the most recently used values.
+
+The file must only be used by one process at a time.
+"""
+
+import functools
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+from threading import Lock
+
+import aplus
+from aplus import Promise
+
+
+# Each record is the digest of its key and the length of its value,
+# followed by the pickled value itself.
+_HEADER = struct.Struct("<32sQ")
+
+
+class _DiskStore:
+    """
+    An append-only file of pickled values, keyed by digest, together
+    with an in-memory index of where each value is.
+    """
+
+    def __init__(self, path, max_bytes):
+        assert max_bytes > 0
+
+        self._path = path
+        self._max_bytes = max_bytes
+        self._lock = Lock()
+        # The offset and length of each value in the file, and a counter
+        # recording when it was last used.
+        self._index = {}
+        self._clock = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._file = open(path, "a+b")
+        self._size = self._load()
+        self._map = None
+
+    def _load(self):
+        """
+        Build the index from the records in the file.  A record which
+        was only partly written (because the process died while writing
+        it) is discarded, along with anything after it.
+        """
+        self._file.seek(0)
+        data = self._file.read()
+        offset = 0
+
+        while offset + _HEADER.size <= len(data):
+            digest, length = _HEADER.unpack_from(data, offset)
+            start = offset + _HEADER.size
+            if start + length > len(data):
+                break
+            self._clock += 1
+            self._index[digest] = [start, length, self._clock]
+            offset = start + length
+
+        if offset < len(data):
+            self._file.truncate(offset)
+        return offset
+
+    def _view(self):
+        """A memory map of the file, remapped whenever it has grown."""
+        if self._map is None or len(self._map) < self._size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), self._size, access=mmap.ACCESS_READ)
+        return self._map
+
+    def get(self, digest):
+        """
+        Return a (found, value) pair for the given digest.  A value
+        which can't be unpickled (for instance because its class has
+        since changed) is dropped and counts as a miss, as does any
+        lookup once the store is closed.
+        """
+        with self._lock:
+            entry = self._index.get(digest)
+            if entry is None or self._file is None:
+                self.misses += 1
+                return False, None
+
+            start, length, _ = entry
+            self._clock += 1
+            entry[2] = self._clock
+            data = self._view()[start:start + length]
+
+        try:
+            value = pickle.loads(data)
+        except Exception:
+            with self._lock:
+                if self._index.get(digest) is entry:
+                    del self._index[digest]
+                self.misses += 1
+            return False, None
+
+        with self._lock:
+            self.hits += 1
+        return True, value
+
+    def put(self, digest, value):
+        """
+        Store a value, returning False if it can't be pickled.
+        """
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return False
+
+        with self._lock:
+            if self._file is None:
+                return False
+
+            try:
+                self._file.seek(0, os.SEEK_END)
+                self._file.write(_HEADER.pack(digest, len(data)))
+                self._file.write(data)
+                self._file.flush()
+            except OSError:
+                # Drop whatever part of the record was written, so the
+                # file still ends with a complete record.
+                try:
+                    self._file.truncate(self._size)
+                except OSError:
+                    pass
+                return False
+
+            self._clock += 1
+            self._index[digest] = [self._size + _HEADER.size, len(data), self._clock]
+            self._size += _HEADER.size + len(data)
+
+            if self._size > self._max_bytes:
+                try:
+                    self._compact()
+                except OSError:
+                    # The value is stored, compaction will be tried
+                    # again by the next write.
+                    pass
+
+        return True
+
+    def _compact(self):
+        """
+        Rewrite the file keeping only the most recently used values
+        that fit in half of max_bytes, so that compaction doesn't
+        happen again after the next few writes.
+        """
+        view = self._view()
+        budget = self._max_bytes // 2
+        kept = []
+
+        for digest, entry in sorted(self._index.items(), key=lambda item: -item[1][2]):
+            size = _HEADER.size + entry[1]
+            if size > budget:
+                continue
+            budget -= size
+            kept.append((digest, entry))
+
+        # Keep the surviving values in their original order.
+        kept.sort(key=lambda item: item[1][0])
+
+        tmp = self._path + ".tmp"
+        index = {}
+        offset = 0
+        try:
+            with open(tmp, "wb") as out:
+                for digest, (start, length, used) in kept:
+                    out.write(_HEADER.pack(digest, length))
+                    out.write(view[start:start + length])
+                    index[digest] = [offset + _HEADER.size, length, used]
+                    offset += _HEADER.size + length
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        self._map.close()
+        self._map = None
+        self._file.close()
+        try:
+            os.replace(tmp, self._path)
+        finally:
+            # If the file couldn't be replaced the old one, and the
+            # index of it, are still good.
+            self._file = open(self._path, "a+b")
+
+        self._index = index
+        self._size = offset
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def size(self):
+        return self._size
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# The open stores, by the real path of their file, and the number of
+# functions using each, so that functions cached in the same file
+# share one index of it.
+_stores = {}
+_storesLock = Lock()
+
+
+def _openStore(path, max_bytes):
+    key = os.path.realpath(path)
+    with _storesLock:
+        entry = _stores.get(key)
+        if entry is None:
+            entry = _stores[key] = [_DiskStore(path, max_bytes), 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def _closeStore(store):
+    with _storesLock:
+        key = os.path.realpath(store._path)
+        entry = _stores.get(key)
+        if entry is None or entry[0] is not store:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del _stores[key]
+    store.close()
+
+
+def _digest(f, args, kwargs):
+    """
+    The digest identifying a call, or None if its arguments can't be
+    pickled.
+    """
+    try:
+        key = pickle.dumps((f.__module__, f.__qualname__, args, sorted(kwargs.items())),
+                           pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return None
+    return hashlib.sha256(key).digest()
+
+
+def disk_cache(path, max_bytes=64 * 1024 * 1024, executor=None):
+    """
+    A decorator which makes calls to a function run with spawn (or on
+    the given executor) and return promises, while keeping the values
+    it produces in the file at path.
+
+    A call whose arguments have been seen before returns an already
+    fulfilled promise, with the stored value, without running anything.
+    Concurrent calls with the same arguments share one run of the
+    function.  Rejections are not stored, nor are values (or calls
+    with arguments) which can't be pickled.  Once the file grows beyond
+    max_bytes it is rewritten with the values most recently used.
+
+    The decorated function has a cache_info method, returning the
+    numbers of hits and misses, the number of values stored and the
+    size of the file, and a cache_close method which closes the file.
+
+    Functions cached in the same file share it (and its statistics),
+    with the max_bytes given when it was first opened, and it is only
+    closed once each of them has called cache_close.
+    """
+
+    def decorator(f):
+        store = _openStore(path, max_bytes)
+        inflight = {}
+        lock = Lock()
+        state = {"closed": False}
+
+        def run(args, kwargs):
+            call = lambda: f(*args, **kwargs)
+            if executor is None:
+                return aplus.spawn(call)
+            return executor.submit(call)
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            digest = _digest(f, args, kwargs)
+            if digest is None:
+                return run(args, kwargs)
+
+            with lock:
+                p = inflight.get(digest)
+                if p is not None:
+                    return p
+
+                found, value = store.get(digest)
+                if found:
+                    return Promise.fulfilled(value)
+
+                p = inflight[digest] = Promise()
+
+            # The value is stored before the call stops being in flight
+            # and before the promise is fulfilled, so that no caller
+            # misses both and a value which has been seen is found.
+            def fulfilled(v):
+                try:
+                    store.put(digest, v)
+                finally:
+                    finished()
+                    p.fulfill(v)
+
+            def rejected(r):
+                finished()
+                p.reject(r)
+
+            def finished():
+                with lock:
+                    del inflight[digest]
+
+            try:
+                result = run(args, kwargs)
+            except Exception as e:
+                rejected(e)
+                return p
+
+            result.done(fulfilled, rejected)
+            return p
+
+        def cache_info():
+            return {
+                "hits": store.hits,
+                "misses": store.misses,
+                "entries": len(store),
+                "bytes": store.size,
+            }
+
+        def cache_close():
+            with lock:
+                if state["closed"]:
+                    return
+                state["closed"] = True
+            _closeStore(store)
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_close = cache_close
+        return wrapper
+
+    return decorator
@@ -0,0 +1,85 @@
+"""
+Delivery of callbacks to a particular thread.
+
+A promise's callbacks normally run on whichever thread settles it.
+Handlers passed to then or done with on=dispatcher are instead queued
+on the dispatcher, to be run by the thread which owns it when it calls
+run_pending.  The owner is woken once for each batch of callbacks,
+rather than once per callback, either through the wakeup function
+given to the dispatcher or by waiting on it.
+"""
+
+from collections import deque
+from threading import Event, Lock
+
+
+class Dispatcher:
+    """
+    Queues callbacks to be run by the thread which calls run_pending.
+
+    wakeup, if given, is called (on the thread queuing the callback)
+    whenever a callback is queued while none were pending, so the
+    target thread or event loop can be told to call run_pending.  More
+    callbacks queued before it does so join the same batch.
+    """
+
+    def __init__(self, wakeup=None):
+        self._wakeup = wakeup
+        self._lock = Lock()
+        self._pending = deque()
+        self._ready = Event()
+
+    @staticmethod
+    def for_asyncio(loop):
+        """
+        A dispatcher whose callbacks are run by the given asyncio event
+        loop.
+        """
+        dispatcher = Dispatcher()
+        dispatcher._wakeup = lambda: loop.call_soon_threadsafe(dispatcher.run_pending)
+        return dispatcher
+
+    def call_soon(self, f, *args):
+        """
+        Queue f to be called with the given arguments by run_pending.
+        """
+        with self._lock:
+            self._pending.append((f, args))
+            first = len(self._pending) == 1
+
+        if first:
+            self._ready.set()
+            if self._wakeup is not None:
+                self._wakeup()
+
+    @property
+    def pending(self):
+        """The number of callbacks waiting to be run."""
+        return len(self._pending)
+
+    def run_pending(self):
+        """
+        Run the callbacks queued so far, ignoring any errors they
+        raise, and return how many were run.  Callbacks queued while
+        they run are left for the next call.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = deque()
+            self._ready.clear()
+
+        for f, args in pending:
+            try:
+                f(*args)
+            except Exception:
+                # Ignore errors in handlers
+                pass
+
+        return len(pending)
+
+    def wait(self, timeout=None):
+        """
+        Block until there are callbacks to run, or the timeout expires.
+        Returns whether there are.
+        """
+        return self._ready.wait(timeout)
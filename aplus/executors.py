@@ -0,0 +1,417 @@
+"""
+The thread pool behind spawn.
+
+Jobs are queued in priority lanes and run by a fixed maximum number of
+worker threads.  Some capacity can be reserved for the more urgent
+lanes, so that a backlog of bulk work can't occupy every worker, and
+jobs which have waited too long are run ahead of everything else so
+that the least urgent lanes are never starved.
+
+A KeyedExecutor runs jobs one at a time per key on top of a shared
+pool.
+"""
+
+from collections import deque
+from threading import Condition, Lock, Thread
+import time
+
+import aplus
+from aplus import Promise, _expired, _isFunction, _process, _timer
+from aplus.policies import PolicyRejected, _withPolicies
+
+
+# Priorities understood by the default executor, most urgent first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class _LaneStats:
+    def __init__(self):
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+
+    def add(self, other):
+        self.submitted += other.submitted
+        self.started += other.started
+        self.completed += other.completed
+        self.failed += other.failed
+        self.expired += other.expired
+        self.total_wait += other.total_wait
+        self.max_wait = max(self.max_wait, other.max_wait)
+        self.total_run += other.total_run
+        self.max_run = max(self.max_run, other.max_run)
+
+    def snapshot(self, queued):
+        return {
+            "queued": queued,
+            "submitted": self.submitted,
+            "started": self.started,
+            "completed": self.completed,
+            "failed": self.failed,
+            "expired": self.expired,
+            "total_wait": self.total_wait,
+            "max_wait": self.max_wait,
+            "mean_wait": self.total_wait / self.started if self.started else 0.0,
+            "total_run": self.total_run,
+            "max_run": self.max_run,
+            "mean_run": self.total_run / self.completed if self.completed else 0.0,
+        }
+
+
+class PriorityExecutor:
+    """
+    Runs functions on up to max_workers threads, returning promises
+    for their results.
+
+    Jobs are submitted to one of `lanes` lanes, numbered from 0 (the
+    most urgent) upwards, and a free worker always takes the oldest job
+    from the most urgent lane it is allowed to serve.  The reserved
+    argument maps a lane to a number of workers kept for that lane and
+    more urgent ones: jobs from less urgent lanes are not started if
+    doing so would leave fewer than that many workers free.  A job
+    which has been queued for more than max_wait seconds is started
+    before any other, regardless of lanes and reservations.
+
+    Jobs may also be given a deadline.  A job whose deadline has passed
+    by the time a worker takes it is not run at all, so that under
+    overload stale work is shed rather than adding to the backlog.
+
+    The load on the executor can be read with stats, or pushed
+    periodically to a function given to set_exporter.
+    """
+
+    def __init__(self, max_workers=5, lanes=3, reserved=None, max_wait=None):
+        assert max_workers > 0
+        assert lanes > 0
+
+        reserved = reserved or {}
+        assert sum(reserved.values()) < max_workers
+
+        self._max_workers = max_workers
+        self._max_wait = max_wait
+        self._queues = [deque() for lane in range(lanes)]
+        self._stats = [_LaneStats() for lane in range(lanes)]
+
+        # The number of workers which must stay free when starting
+        # a job from each lane.
+        self._keepFree = [sum(n for l, n in reserved.items() if l < lane)
+                          for lane in range(lanes)]
+
+        self._cond = Condition(Lock())
+        self._threads = 0
+        self._idle = 0
+        self._busy = 0
+        self._shutdown = False
+        # Jobs refused after shutdown or by an admission policy.
+        self._rejected = 0
+
+        self._exporter = None
+        self._exportEntry = None
+
+    @property
+    def lanes(self):
+        return len(self._queues)
+
+    def submit(self, f, priority=PRIORITY_NORMAL, deadline=None, policy=None):
+        """
+        Queue f to be called on a worker thread, in the lane given by
+        priority.  Returns a promise for its result.  If f can't be
+        started before the deadline (a time.monotonic() timestamp), it
+        is dropped and the promise is rejected with DeadlineExceeded.
+
+        If a policy (or a list of them) is given, f is only queued once
+        it has been admitted, so waiting for admission doesn't tie up a
+        worker.
+        """
+        assert _isFunction(f)
+
+        if policy is not None:
+            p = _withPolicies(policy, lambda: self.submit(f, priority, deadline),
+                              _timer.schedule)
+            p.addErrback(self._countRejection)
+            return p
+
+        lane = min(max(int(priority), 0), len(self._queues) - 1)
+        p = Promise()
+        if aplus._tracer is not None:
+            aplus._tracer._spawned(p, f)
+
+        with self._cond:
+            if self._shutdown:
+                self._rejected += 1
+                raise RuntimeError("Cannot submit to an executor after shutdown")
+
+            self._queues[lane].append((time.monotonic(), f, p, deadline))
+            self._stats[lane].submitted += 1
+
+            # Idle workers only stop counting as idle once they wake up,
+            # so compare them against everything that is queued.
+            if self._idle > 0:
+                self._cond.notify()
+            if sum(len(q) for q in self._queues) > self._idle and \
+                    self._threads < self._max_workers:
+                self._threads += 1
+                t = Thread(target=self._work, name="aplus-worker-%d" % self._threads)
+                t.daemon = True
+                t.start()
+
+        return p
+
+    def _take(self, now):
+        """
+        Remove and return the next job which may be started, if any.
+        Must be called with the lock held.
+        """
+        queues = self._queues
+
+        if self._max_wait is not None:
+            oldest = None
+            for lane, q in enumerate(queues):
+                if q and (oldest is None or q[0][0] < queues[oldest][0][0]):
+                    oldest = lane
+            if oldest is not None and now - queues[oldest][0][0] > self._max_wait:
+                return oldest, queues[oldest].popleft()
+
+        # Reservations no longer apply once the executor is draining
+        free = self._max_workers - self._busy
+        for lane, q in enumerate(queues):
+            if q and (free > self._keepFree[lane] or self._shutdown):
+                return lane, q.popleft()
+
+        return None
+
+    def _nextTimeout(self, now):
+        """
+        How long an idle worker may sleep before a queued job that it
+        is not yet allowed to start counts as starved.
+        """
+        if self._max_wait is None:
+            return None
+
+        oldest = min(q[0][0] for q in self._queues if q) if any(self._queues) else None
+        if oldest is None:
+            return None
+        return max(oldest + self._max_wait - now, 0) + 0.001
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    job = self._take(now)
+                    if job is not None or self._shutdown:
+                        break
+
+                    self._idle += 1
+                    self._cond.wait(self._nextTimeout(now))
+                    self._idle -= 1
+
+                if job is None:
+                    self._threads -= 1
+                    return
+
+                lane, (submitted, f, p, deadline) = job
+                stats = self._stats[lane]
+
+                if deadline is not None and now > deadline:
+                    stats.expired += 1
+                    expired = True
+                else:
+                    wait = now - submitted
+                    stats.started += 1
+                    stats.total_wait += wait
+                    stats.max_wait = max(stats.max_wait, wait)
+                    self._busy += 1
+                    expired = False
+
+            if expired:
+                _expired(p, deadline)
+                continue
+
+            start = time.monotonic()
+            try:
+                _process(p, f)
+            finally:
+                run = time.monotonic() - start
+                with self._cond:
+                    self._busy -= 1
+                    stats.completed += 1
+                    if p._state == Promise.REJECTED:
+                        stats.failed += 1
+                    stats.total_run += run
+                    stats.max_run = max(stats.max_run, run)
+
+    def _countRejection(self, reason):
+        if isinstance(reason, PolicyRejected):
+            with self._cond:
+                self._rejected += 1
+
+    def lane_stats(self):
+        """
+        A list with a dictionary for each lane, giving the number of
+        jobs queued, submitted, started, completed, failed (those whose
+        promise was rejected when the function returned) and dropped
+        because their deadline had expired, and the total, maximum and
+        mean time (in seconds) that started jobs spent queued and that
+        completed jobs spent running.
+        """
+        with self._cond:
+            return [stats.snapshot(len(q)) for stats, q in zip(self._stats, self._queues)]
+
+    def stats(self):
+        """
+        A snapshot of the load on the executor: the number of worker
+        threads, how many of them are running jobs and how many are
+        idle, the number of jobs rejected (submitted after shutdown, or
+        refused by an admission policy), the totals over all lanes of
+        the figures given by lane_stats, and those figures for each
+        lane, under "lanes".
+        """
+        with self._cond:
+            total = _LaneStats()
+            for stats in self._stats:
+                total.add(stats)
+
+            snapshot = total.snapshot(sum(len(q) for q in self._queues))
+            snapshot.update({
+                "workers": self._threads,
+                "max_workers": self._max_workers,
+                "active": self._busy,
+                "idle": self._idle,
+                "rejected": self._rejected,
+                "lanes": [stats.snapshot(len(q)) for stats, q in zip(self._stats, self._queues)],
+            })
+            return snapshot
+
+    def set_exporter(self, exporter, interval=10.0):
+        """
+        Call exporter with the result of stats every interval seconds,
+        from the shared timer thread, replacing any previous exporter.
+        Errors raised by the exporter are ignored.  Pass None to stop
+        exporting.  A final snapshot is exported when the executor is
+        shut down.
+        """
+        with self._cond:
+            entry = self._exportEntry
+            self._exportEntry = None
+            self._exporter = None
+            if exporter is not None:
+                assert interval > 0
+
+                self._exporter = (exporter, interval)
+                self._exportEntry = _timer.schedule(interval, self._export, self._exporter)
+
+        if entry is not None:
+            entry.cancel()
+
+    def _export(self, current):
+        with self._cond:
+            if self._exporter is not current:
+                return
+            exporter, interval = current
+            if not self._shutdown:
+                self._exportEntry = _timer.schedule(interval, self._export, current)
+
+        try:
+            exporter(self.stats())
+        except Exception:
+            # Ignore errors in exporters
+            pass
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting jobs.  Jobs already queued are still run, and if
+        wait is true this blocks until they have all finished.
+        """
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+
+            while wait and (self._threads > 0 and (self._busy > 0 or any(self._queues))):
+                self._cond.wait(0.05)
+
+            current = self._exporter
+            entry = self._exportEntry
+            self._exportEntry = None
+
+        if entry is not None:
+            entry.cancel()
+            self._export(current)
+
+
+class KeyedExecutor:
+    """
+    Runs functions so that those submitted with the same key run one
+    at a time, in the order they were submitted, while those with
+    different keys run in parallel.
+
+    No threads are created: each job is handed in turn to the given
+    executor (anything with a submit(f) method returning a promise) or,
+    by default, to spawn.  The queue for a key only exists while it has
+    jobs running or waiting, so keys which fall idle cost nothing.
+    """
+
+    def __init__(self, executor=None):
+        self._executor = executor
+        self._lock = Lock()
+        # The jobs waiting behind the running one, for each active key.
+        self._keys = {}
+
+    @property
+    def active_keys(self):
+        """The number of keys with jobs running or waiting."""
+        return len(self._keys)
+
+    def submit(self, key, f):
+        """
+        Run f once all the jobs previously submitted with the same key
+        have finished, returning a promise for its result.  A job which
+        fails does not hold up the ones after it.
+        """
+        assert _isFunction(f)
+
+        p = Promise()
+        with self._lock:
+            waiting = self._keys.get(key)
+            if waiting is not None:
+                waiting.append((f, p))
+                return p
+            self._keys[key] = deque()
+
+        self._start(key, f, p)
+        return p
+
+    def _start(self, key, f, p):
+        try:
+            if self._executor is None:
+                result = aplus.spawn(f)
+            else:
+                result = self._executor.submit(f)
+        except Exception as e:
+            p.reject(e)
+            self._next(key)
+            return
+
+        def finished(_):
+            self._next(key)
+
+        result.done(finished, finished)
+        p.fulfill(result)
+
+    def _next(self, key):
+        with self._lock:
+            waiting = self._keys[key]
+            if not waiting:
+                del self._keys[key]
+                return
+            f, p = waiting.popleft()
+
+        self._start(key, f, p)
@@ -0,0 +1,168 @@
+"""
+Hedged requests, which trade a little extra load for lower tail latency.
+
+hedge runs a function with spawn and, if it hasn't succeeded within a
+delay, runs another copy of it, taking whichever succeeds first.  The
+delay is either fixed or learned from the latencies seen so far, so
+that only the slowest few percent of calls are duplicated.  Delays are
+handled by the shared timer, not by a thread sleeping per call.
+"""
+
+from collections import OrderedDict, deque
+from threading import Lock
+import time
+import types
+import weakref
+
+import aplus
+from aplus import Promise, _timer
+
+
+class _LatencyHistory:
+    """The most recent latencies observed for one hedged function."""
+
+    def __init__(self, size):
+        self._lock = Lock()
+        self._samples = deque(maxlen=size)
+
+    def add(self, latency):
+        with self._lock:
+            self._samples.append(latency)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, fraction):
+        with self._lock:
+            ordered = sorted(self._samples)
+        return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+# Latency history for each hedged function (or key), used when the
+# delay is given as a percentile.  Histories for plain functions are
+# dropped along with the function; those for other keys are kept for
+# the _MAX_HISTORIES most recently used keys.
+_fnHistories = weakref.WeakKeyDictionary()
+_histories = OrderedDict()
+_historiesLock = Lock()
+
+# How many latencies are remembered per key, and how many must have
+# been seen before a learned percentile is trusted.
+_HISTORY_SIZE = 1000
+_MIN_SAMPLES = 20
+_MAX_HISTORIES = 1000
+
+
+def _history(key):
+    with _historiesLock:
+        if isinstance(key, types.FunctionType):
+            history = _fnHistories.get(key)
+            if history is None:
+                history = _fnHistories[key] = _LatencyHistory(_HISTORY_SIZE)
+            return history
+
+        history = _histories.get(key)
+        if history is None:
+            history = _histories[key] = _LatencyHistory(_HISTORY_SIZE)
+            if len(_histories) > _MAX_HISTORIES:
+                _histories.popitem(last=False)
+        else:
+            _histories.move_to_end(key)
+        return history
+
+
+def _delay(after, history, fallback):
+    """
+    The hedging delay in seconds, given either directly or as a
+    percentile such as "p95" of the observed latencies.
+    """
+    if isinstance(after, str):
+        assert after.startswith("p")
+
+        if len(history) < _MIN_SAMPLES:
+            return fallback
+        return history.percentile(float(after[1:]) / 100.0)
+
+    return after
+
+
+def hedge(fn, after=0.1, max_copies=2, key=None, fallback=0.1, executor=None):
+    """
+    Run fn with spawn (or on the given executor) and return a promise
+    for its result.  If no copy has succeeded after the delay, another
+    copy of fn is started, up to max_copies in total, and the first
+    copy to succeed fulfills the promise.  The others are ignored once
+    they finish, and no further copies are started.  A copy which fails
+    causes the next one to be started immediately, and the promise is
+    only rejected (with the last reason) when every copy has failed.
+
+    The delay, after, is either a number of seconds or a percentile of
+    the latencies seen so far, such as "p95".  Latencies are recorded
+    per key (fn itself by default), so pass a key when fn is created
+    afresh for each call.  Only the histories of the most recently used
+    keys are kept, and a function's history is discarded along with
+    it.  Until enough have been seen the fallback delay is used.
+    """
+    assert max_copies >= 1
+
+    if executor is None:
+        submit, later = aplus.spawn, aplus._later
+    else:
+        submit, later = executor.submit, _timer.schedule
+
+    if isinstance(after, str):
+        history = _history(fn if key is None else key)
+    else:
+        history = None
+    delay = _delay(after, history, fallback)
+
+    ret = Promise()
+    lock = Lock()
+    state = {"launched": 0, "failed": 0, "timer": None}
+
+    def succeeded(started, v):
+        if history is not None:
+            history.add(time.monotonic() - started)
+
+        with lock:
+            timer, state["timer"] = state["timer"], None
+        if timer is not None:
+            timer.cancel()
+
+        ret.fulfill(v)
+
+    def failed(r):
+        with lock:
+            state["failed"] += 1
+            exhausted = state["failed"] == max_copies
+
+        if exhausted:
+            ret.reject(r)
+        else:
+            launch()
+
+    def launch():
+        with lock:
+            if not ret.isPending or state["launched"] == max_copies:
+                return
+
+            state["launched"] += 1
+            more = state["launched"] < max_copies
+
+            timer, state["timer"] = state["timer"], None
+            if timer is not None:
+                timer.cancel()
+            if more:
+                timer = state["timer"] = later(delay, launch)
+
+        started = time.monotonic()
+        try:
+            p = submit(fn)
+        except Exception as e:
+            failed(e)
+            return
+
+        p.done(lambda v: succeeded(started, v), failed)
+
+    launch()
+    return ret
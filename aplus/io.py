@@ -0,0 +1,570 @@
+"""
+Non-blocking socket and pipe I/O returning promises.
+
+An EventLoop runs a single thread waiting on a selector for all the
+sockets and pipes it has been asked to use, so that a connection which
+is idle costs no thread of its own.  Its recv, send, accept, connect
+and read_until methods return promises which are settled by that
+thread once the operation has completed, and the module level
+functions of the same names use a shared loop started on first use.
+Its run_process method uses the same thread to collect the output of
+child processes and to notice when they exit.
+
+Operations on the same socket are performed in the order they were
+requested, reads and writes being queued separately.  Sockets and
+pipes are switched to non-blocking mode when first used, and callbacks
+registered on the promises run on the loop thread, so they shouldn't
+block.
+"""
+
+from collections import deque
+from threading import Lock, Thread
+import errno
+import os
+import selectors
+import socket
+import subprocess
+
+from aplus import Promise, _timer, listPromise
+
+
+class _Channel:
+    """The operations waiting on one file descriptor."""
+
+    def __init__(self, obj, fd):
+        self.obj = obj
+        self.fd = fd
+        self.readers = deque()
+        self.writers = deque()
+        # Data read past the delimiter by read_until, returned first by
+        # the next read.
+        self.buffer = b""
+        self.events = 0
+
+
+def _read(obj, n):
+    if hasattr(obj, "recv"):
+        return obj.recv(n)
+    return os.read(_fileno(obj), n)
+
+
+def _write(obj, data):
+    if hasattr(obj, "send"):
+        return obj.send(data)
+    return os.write(_fileno(obj), data)
+
+
+def _fileno(obj):
+    return obj if isinstance(obj, int) else obj.fileno()
+
+
+def _sameFile(a, b):
+    return a is b or (isinstance(a, int) and a == b)
+
+
+class EventLoop:
+    """
+    A thread multiplexing I/O on many sockets and pipes with a selector.
+
+    Each operation is given as a function which attempts it without
+    blocking, returning a (done, value) pair, and a promise which the
+    loop fulfills with the value (or rejects with any exception the
+    function raises) once it is done.  The function is called again
+    each time the file becomes ready until then.
+    """
+
+    # How much is read at a time by read_until and run_process.
+    CHUNK_SIZE = 1 << 16
+    # How often child processes are polled where they can't be waited
+    # for by the selector.
+    POLL_INTERVAL = 0.01
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._wakeReader, self._wakeWriter = socket.socketpair()
+        self._wakeReader.setblocking(False)
+        self._wakeWriter.setblocking(False)
+        self._selector.register(self._wakeReader, selectors.EVENT_READ, None)
+
+        self._lock = Lock()
+        self._calls = deque()
+        self._channels = {}
+        self._thread = None
+        self._closed = False
+
+    def call_soon(self, f, *args):
+        """
+        Call f with the given arguments on the loop thread.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Event loop is closed")
+
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="aplus-io")
+                self._thread.daemon = True
+                self._thread.start()
+
+            self._calls.append((f, args))
+            # The loop is woken once for however many calls are queued
+            # before it gets to them.
+            wake = len(self._calls) == 1
+
+        if wake:
+            self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeWriter.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _run(self):
+        while True:
+            for key, mask in self._selector.select():
+                channel = key.data
+                if channel is None:
+                    try:
+                        while self._wakeReader.recv(4096):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    continue
+
+                try:
+                    if mask & selectors.EVENT_READ:
+                        self._service(channel.readers, channel)
+                    if mask & selectors.EVENT_WRITE:
+                        self._service(channel.writers, channel)
+                    self._update(channel)
+                except Exception as e:
+                    self._fail(channel, e)
+
+            with self._lock:
+                calls = self._calls
+                self._calls = deque()
+                closed = self._closed
+
+            for f, args in calls:
+                try:
+                    f(*args)
+                except Exception:
+                    # Ignore errors in calls, which mustn't stop the loop
+                    pass
+
+            if closed:
+                self._shutdown()
+                return
+
+    def _service(self, ops, channel):
+        """
+        Perform as many of the queued operations as can be done without
+        blocking.
+        """
+        while ops:
+            attempt, p = ops[0]
+            try:
+                done, value = attempt(channel)
+            except Exception as e:
+                ops.popleft()
+                p.reject(e)
+                continue
+
+            if not done:
+                return
+            ops.popleft()
+            p.fulfill(value)
+
+    def _update(self, channel):
+        """
+        Register the channel for the events its queued operations are
+        waiting for.
+        """
+        events = 0
+        if channel.readers:
+            events |= selectors.EVENT_READ
+        if channel.writers:
+            events |= selectors.EVENT_WRITE
+
+        if events != channel.events:
+            if channel.events == 0:
+                self._selector.register(channel.fd, events, channel)
+            elif events == 0:
+                self._selector.unregister(channel.fd)
+            else:
+                self._selector.modify(channel.fd, events, channel)
+            channel.events = events
+
+        # Channels with nothing waiting and nothing buffered are
+        # forgotten.
+        if events == 0 and not channel.buffer:
+            self._channels.pop(channel.fd, None)
+
+    def submit(self, obj, write, attempt):
+        """
+        Queue an operation on a socket or pipe (anything with a fileno
+        method), returning a promise for its result.  attempt is called
+        on the loop thread with the state of the file descriptor, and
+        write says whether it waits for the file to be writable rather
+        than readable.
+        """
+        p = Promise()
+        self.call_soon(self._submit, obj, write, attempt, p)
+        return p
+
+    def _submit(self, obj, write, attempt, p):
+        try:
+            fd = _fileno(obj)
+            if fd < 0:
+                raise OSError(errno.EBADF, "File is closed")
+
+            channel = self._channels.get(fd)
+            if channel is not None and not _sameFile(channel.obj, obj):
+                # The file the channel was for has been closed without
+                # close(), and its descriptor reused.  Nothing of its
+                # state can carry over to the new file.
+                self._fail(channel, OSError(errno.EBADF, "File was closed"))
+                channel = None
+            if channel is None:
+                os.set_blocking(fd, False)
+                channel = self._channels[fd] = _Channel(obj, fd)
+        except Exception as e:
+            p.reject(e)
+            return
+
+        ops = channel.writers if write else channel.readers
+        ops.append((attempt, p))
+        try:
+            # The operation may well be possible straight away.
+            if len(ops) == 1:
+                self._service(ops, channel)
+            self._update(channel)
+        except Exception as e:
+            self._fail(channel, e)
+
+    def _fail(self, channel, reason):
+        """
+        Forget a channel which can no longer be serviced, rejecting
+        all of its operations with the reason.
+        """
+        self._channels.pop(channel.fd, None)
+        if channel.events:
+            channel.events = 0
+            try:
+                self._selector.unregister(channel.fd)
+            except Exception:
+                pass
+        self._abandon(channel, reason)
+
+    def recv(self, sock, n):
+        """
+        A promise for up to n bytes read from the socket or pipe, which
+        is fulfilled with an empty bytes object at the end of the
+        stream.
+        """
+        def attempt(channel):
+            if channel.buffer:
+                data = channel.buffer[:n]
+                channel.buffer = channel.buffer[n:]
+                return True, data
+
+            try:
+                return True, _read(channel.obj, n)
+            except (BlockingIOError, InterruptedError):
+                return False, None
+
+        return self.submit(sock, False, attempt)
+
+    def read_until(self, sock, delimiter, max_bytes=1 << 20):
+        """
+        A promise for the bytes read from the socket or pipe up to and
+        including the delimiter.  Anything read beyond the delimiter is
+        kept for the next read.  The promise is rejected with EOFError
+        if the stream ends first, or with ValueError if max_bytes are
+        read without finding the delimiter.
+        """
+        def attempt(channel):
+            while True:
+                i = channel.buffer.find(delimiter)
+                if i >= 0:
+                    i += len(delimiter)
+                    data = channel.buffer[:i]
+                    channel.buffer = channel.buffer[i:]
+                    return True, data
+
+                if len(channel.buffer) >= max_bytes:
+                    raise ValueError("Delimiter not found in %d bytes" % max_bytes)
+
+                try:
+                    chunk = _read(channel.obj, self.CHUNK_SIZE)
+                except (BlockingIOError, InterruptedError):
+                    return False, None
+
+                if not chunk:
+                    raise EOFError("Stream ended before the delimiter")
+                channel.buffer += chunk
+
+        return self.submit(sock, False, attempt)
+
+    def send(self, sock, data):
+        """
+        A promise for the number of bytes written, which is fulfilled
+        once all of data has been written to the socket or pipe.
+        """
+        view = memoryview(data).cast("B")
+        sent = [0]
+
+        def attempt(channel):
+            while sent[0] < len(view):
+                try:
+                    sent[0] += _write(channel.obj, view[sent[0]:])
+                except (BlockingIOError, InterruptedError):
+                    return False, None
+            return True, sent[0]
+
+        return self.submit(sock, True, attempt)
+
+    def accept(self, sock):
+        """
+        A promise for a (connection, address) pair accepted by the
+        listening socket.  The connection is in non-blocking mode.
+        """
+        def attempt(channel):
+            try:
+                conn, address = channel.obj.accept()
+            except (BlockingIOError, InterruptedError):
+                return False, None
+            conn.setblocking(False)
+            return True, (conn, address)
+
+        return self.submit(sock, False, attempt)
+
+    def connect(self, sock, address):
+        """
+        A promise which is fulfilled with None once the socket has
+        connected to the address.  The address should already be
+        resolved, since a host name would be looked up on the loop
+        thread.
+        """
+        started = [False]
+
+        def attempt(channel):
+            if not started[0]:
+                started[0] = True
+                err = channel.obj.connect_ex(address)
+                if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    return False, None
+            else:
+                err = channel.obj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+            if err:
+                raise OSError(err, os.strerror(err))
+            return True, None
+
+        return self.submit(sock, True, attempt)
+
+    def run_process(self, args, on_output=None, input=None, **kwargs):
+        """
+        Start a child process and return a promise for a (returncode,
+        stdout, stderr) tuple once it has exited and closed its output.
+        The output is collected as bytes, unless on_output is given, in
+        which case it is called on the loop thread with "stdout" or
+        "stderr" and each chunk as it is read, and None is given in
+        place of the output in the tuple.  If input is given it is
+        written to the child's standard input, which is then closed.
+        Any other arguments are passed on to subprocess.Popen.
+        """
+        if input is not None:
+            kwargs["stdin"] = subprocess.PIPE
+
+        try:
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, **kwargs)
+        except Exception as e:
+            return Promise.rejected(e)
+
+        exited = self._reap(proc)
+
+        if input is not None:
+            def closeInput(_):
+                self.close(proc.stdin)
+
+            # A child which exits without reading its input is not an
+            # error.
+            self.send(proc.stdin, input).done(closeInput, closeInput)
+
+        return listPromise(
+            exited,
+            self._drain(proc.stdout, "stdout", on_output),
+            self._drain(proc.stderr, "stderr", on_output)).then(tuple)
+
+    def _drain(self, pipe, name, on_output):
+        """
+        A promise for everything read from the pipe (or None, if it is
+        passed to on_output instead), fulfilled once it is closed.
+        """
+        ret = Promise()
+        chunks = []
+
+        def received(data):
+            if not data:
+                self.close(pipe)
+                ret.fulfill(None if on_output is not None else b"".join(chunks))
+                return
+
+            if on_output is None:
+                chunks.append(data)
+            else:
+                try:
+                    on_output(name, data)
+                except Exception as e:
+                    self.close(pipe)
+                    ret.reject(e)
+                    return
+
+            self.recv(pipe, self.CHUNK_SIZE).done(received, failed)
+
+        def failed(reason):
+            self.close(pipe)
+            ret.reject(reason)
+
+        self.recv(pipe, self.CHUNK_SIZE).done(received, failed)
+        return ret
+
+    def _reap(self, proc):
+        """
+        A promise for the return code of the child process.  Where the
+        platform can give a file descriptor for the process, the loop
+        waits on that; otherwise the child is polled from the timer.
+        """
+        try:
+            fd = os.pidfd_open(proc.pid)
+        except (AttributeError, OSError):
+            fd = None
+
+        if fd is None:
+            ret = Promise()
+
+            def poll():
+                returncode = proc.poll()
+                if returncode is None:
+                    _timer.schedule(self.POLL_INTERVAL, poll)
+                else:
+                    ret.fulfill(returncode)
+
+            poll()
+            return ret
+
+        def attempt(channel):
+            returncode = proc.poll()
+            return returncode is not None, returncode
+
+        def closeFd(_):
+            self.close(fd)
+
+        ret = self.submit(fd, False, attempt)
+        ret.done(closeFd, closeFd)
+        return ret
+
+    def close(self, sock):
+        """
+        Close the socket or pipe, rejecting any operations still
+        waiting on it.  Returns a promise which is fulfilled once it
+        has been closed.
+        """
+        p = Promise()
+        self.call_soon(self._close, sock, p)
+        return p
+
+    def _close(self, sock, p):
+        try:
+            channel = self._channels.pop(_fileno(sock), None)
+            if channel is not None:
+                if channel.events:
+                    self._selector.unregister(channel.fd)
+                self._abandon(channel, OSError(errno.EBADF, "File was closed"))
+            if isinstance(sock, int):
+                os.close(sock)
+            else:
+                sock.close()
+        except Exception as e:
+            p.reject(e)
+            return
+        p.fulfill(None)
+
+    def _abandon(self, channel, reason):
+        for ops in (channel.readers, channel.writers):
+            while ops:
+                attempt, p = ops.popleft()
+                p.reject(reason)
+
+    def stop(self):
+        """
+        Stop the loop thread, rejecting any operations still waiting.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+
+        if thread is None:
+            self._shutdown()
+        else:
+            self._wake()
+
+    def _shutdown(self):
+        for channel in list(self._channels.values()):
+            self._abandon(channel, RuntimeError("Event loop was stopped"))
+        self._channels.clear()
+        self._selector.close()
+        self._wakeReader.close()
+        self._wakeWriter.close()
+
+
+_loop = None
+_loopLock = Lock()
+
+
+def _defaultLoop():
+    global _loop
+
+    with _loopLock:
+        if _loop is None:
+            _loop = EventLoop()
+        return _loop
+
+
+def recv(sock, n):
+    """EventLoop.recv on the shared loop."""
+    return _defaultLoop().recv(sock, n)
+
+
+def read_until(sock, delimiter, max_bytes=1 << 20):
+    """EventLoop.read_until on the shared loop."""
+    return _defaultLoop().read_until(sock, delimiter, max_bytes)
+
+
+def send(sock, data):
+    """EventLoop.send on the shared loop."""
+    return _defaultLoop().send(sock, data)
+
+
+def accept(sock):
+    """EventLoop.accept on the shared loop."""
+    return _defaultLoop().accept(sock)
+
+
+def connect(sock, address):
+    """EventLoop.connect on the shared loop."""
+    return _defaultLoop().connect(sock, address)
+
+
+def run_process(args, on_output=None, input=None, **kwargs):
+    """EventLoop.run_process on the shared loop."""
+    return _defaultLoop().run_process(args, on_output, input, **kwargs)
+
+
+def close(sock):
+    """EventLoop.close on the shared loop."""
+    return _defaultLoop().close(sock)
@@ -0,0 +1,222 @@
+"""
+Detection of promises which are never settled.
+
+A pending promise keeps its callbacks, and everything their closures
+refer to, alive for as long as it is itself reachable.  While a
+LeakTracker is running, every promise created is recorded, by weak
+reference, with the place in the calling code where it was created,
+until it is settled or garbage collected.  The promises still pending
+can then be counted by creation site and age, and the oldest of them
+listed.
+"""
+
+from threading import Lock
+import os
+import sys
+import time
+import traceback
+import weakref
+
+import aplus
+
+
+# Frames in this package are skipped when looking for where a promise
+# was created.
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(aplus.__file__))
+
+# The upper bounds, in seconds, of the age buckets in report.
+_AGE_BUCKETS = (1.0, 10.0, 60.0, 600.0)
+
+
+class _Record:
+    __slots__ = ("ref", "site", "created", "stack")
+
+    def __init__(self, ref, site, created, stack):
+        self.ref = ref
+        self.site = site
+        self.created = created
+        self.stack = stack
+
+
+def _callerFrame():
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename.startswith(_PACKAGE_DIR):
+        frame = frame.f_back
+    return frame
+
+
+def _retained(p):
+    """The number of callbacks and errbacks a promise is holding."""
+    callbacks = p._callbacks
+    errbacks = p._errbacks
+    return (len(callbacks) if callbacks else 0) + (len(errbacks) if errbacks else 0)
+
+
+class LeakTracker:
+    """
+    An opt-in tracker of pending promises.  Only one tracker can be
+    running at a time.  At most max_tracked promises are recorded at
+    once; promises created beyond that are counted in `untracked` but
+    not recorded.  If stacks is true the creation stack (up to
+    stack_depth frames) is kept for each promise, which costs more
+    than recording the creation site alone.
+
+    tracker = LeakTracker().start()
+    ...
+    print(tracker.report())
+    tracker.dump()
+    """
+
+    def __init__(self, max_tracked=100000, stacks=False, stack_depth=16):
+        self._max_tracked = max_tracked
+        self._stacks = stacks
+        self._stack_depth = stack_depth
+        self._lock = Lock()
+        self._records = {}
+        self.untracked = 0
+
+    def start(self):
+        if aplus._leaks is not None and aplus._leaks is not self:
+            raise ValueError("Another leak tracker is already running")
+        aplus._leaks = self
+        return self
+
+    def stop(self):
+        if aplus._leaks is self:
+            aplus._leaks = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._records = {}
+            self.untracked = 0
+
+    def _created(self, p):
+        """Called by Promise.__init__ when tracking."""
+        if len(self._records) >= self._max_tracked:
+            self.untracked += 1
+            return
+
+        frame = _callerFrame()
+        if frame is None:
+            site = "<unknown>"
+        else:
+            site = "%s:%d in %s" % (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+        stack = None
+        if self._stacks and frame is not None:
+            stack = traceback.extract_stack(frame, self._stack_depth)
+
+        key = id(p)
+        records = self._records
+
+        # This may run during garbage collection while the lock is
+        # held, so it relies on the atomicity of dict operations rather
+        # than taking the lock.
+        def collected(ref):
+            if records.get(key) is record:
+                records.pop(key, None)
+
+        record = _Record(weakref.ref(p, collected), site, time.monotonic(), stack)
+        with self._lock:
+            records[key] = record
+
+    def _settled(self, p):
+        """Called when a promise is settled while tracking."""
+        with self._lock:
+            record = self._records.get(id(p))
+            if record is not None and record.ref() is p:
+                del self._records[id(p)]
+
+    def _pending(self):
+        """The (record, promise) pairs for the promises still pending."""
+        with self._lock:
+            records = list(self._records.values())
+
+        pending = []
+        for record in records:
+            p = record.ref()
+            if p is not None and p._state == aplus.Promise.PENDING:
+                pending.append((record, p))
+        return pending
+
+    @property
+    def pending(self):
+        """The number of tracked promises still pending."""
+        return len(self._pending())
+
+    def report(self):
+        """
+        A summary of the pending promises: their number, the number of
+        callbacks they retain, how many fall in each age bucket (keyed
+        by the bucket's upper bound in seconds, or None for the
+        oldest), and for each creation site the number of promises, the
+        callbacks they retain and the age of the oldest.
+        """
+        now = time.monotonic()
+        ages = dict.fromkeys(_AGE_BUCKETS + (None,), 0)
+        sites = {}
+        retained = 0
+
+        for record, p in self._pending():
+            age = now - record.created
+            callbacks = _retained(p)
+            retained += callbacks
+
+            for bound in _AGE_BUCKETS:
+                if age < bound:
+                    ages[bound] += 1
+                    break
+            else:
+                ages[None] += 1
+
+            stats = sites.get(record.site)
+            if stats is None:
+                stats = sites[record.site] = {"count": 0, "callbacks": 0, "oldest": 0.0}
+            stats["count"] += 1
+            stats["callbacks"] += callbacks
+            stats["oldest"] = max(stats["oldest"], age)
+
+        return {
+            "pending": sum(stats["count"] for stats in sites.values()),
+            "callbacks": retained,
+            "untracked": self.untracked,
+            "ages": ages,
+            "sites": sites,
+        }
+
+    def oldest(self, n=10):
+        """
+        A list of up to n dictionaries describing the oldest pending
+        promises, oldest first, giving the promise, its creation site,
+        age, retained callbacks and (if stacks are kept) creation stack.
+        """
+        now = time.monotonic()
+        pending = sorted(self._pending(), key=lambda item: item[0].created)[:n]
+        return [{
+            "promise": p,
+            "site": record.site,
+            "age": now - record.created,
+            "callbacks": _retained(p),
+            "stack": record.stack,
+        } for record, p in pending]
+
+    def dump(self, n=10, file=None):
+        """
+        Write a description of the n oldest pending promises to file
+        (by default sys.stderr).
+        """
+        if file is None:
+            file = sys.stderr
+
+        for entry in self.oldest(n):
+            file.write("Pending for %.3fs, %d callbacks, created at %s\n"
+                       % (entry["age"], entry["callbacks"], entry["site"]))
+            if entry["stack"] is not None:
+                file.write("".join(traceback.format_list(entry["stack"])))
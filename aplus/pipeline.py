@@ -0,0 +1,221 @@
+"""
+Multi-stage pipelines whose stages are connected by bounded queues.
+
+Each stage runs its function on its own set of worker threads, taking
+items from a bounded input queue and putting its results on the input
+queue of the next stage.  When a stage falls behind, its queue fills
+up and the workers of the stage before it block, so a slow sink
+throttles everything upstream of it (all the way back to submit).
+"""
+
+from threading import Lock, Thread
+import queue
+import time
+
+from aplus import Promise, _isFunction, _isPromise, _promisify
+
+
+# Placed on a stage's queue to tell one of its workers to exit.
+_STOP = object()
+
+
+class _Stage:
+    def __init__(self, pipeline, f, concurrency, queue_size, name):
+        assert concurrency > 0
+        assert queue_size > 0
+
+        self.f = f
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue.Queue(queue_size)
+        self.next = None
+
+        self._pipeline = pipeline
+        self._lock = Lock()
+        self._active = 0
+        self._processed = 0
+        self._failed = 0
+        self._busy = 0.0
+        self._stopped = 0
+        self._started = None
+
+    def start(self):
+        self._started = time.monotonic()
+
+        for i in range(self.concurrency):
+            t = Thread(target=self._work, name="%s-%d" % (self.name, i))
+            t.daemon = True
+            t.start()
+
+    def _work(self):
+        while True:
+            entry = self.queue.get()
+
+            if entry is _STOP:
+                with self._lock:
+                    self._stopped += 1
+                    last = self._stopped == self.concurrency
+
+                if last:
+                    self._pipeline._stageFinished(self)
+                return
+
+            item, promise = entry
+
+            with self._lock:
+                self._active += 1
+
+            start = time.monotonic()
+            try:
+                result = self.f(item)
+
+                # Stages may themselves be asynchronous, in which case
+                # the worker (and so a slot of this stage) is held until
+                # the result is available.
+                if _isPromise(result):
+                    result = _promisify(result).get()
+            except Exception as e:
+                with self._lock:
+                    self._active -= 1
+                    self._failed += 1
+                    self._busy += time.monotonic() - start
+
+                promise.reject(e)
+                continue
+
+            with self._lock:
+                self._active -= 1
+                self._processed += 1
+                self._busy += time.monotonic() - start
+
+            if self.next is None:
+                promise.fulfill(result)
+            else:
+                self.next.queue.put((result, promise))
+
+    def metrics(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._started if self._started else 0.0
+
+            return {
+                "name": self.name,
+                "concurrency": self.concurrency,
+                "queue_size": self.queue.maxsize,
+                "queue_depth": self.queue.qsize(),
+                "active": self._active,
+                "processed": self._processed,
+                "failed": self._failed,
+                "busy_time": self._busy,
+                "throughput": self._processed / elapsed if elapsed > 0 else 0.0,
+            }
+
+
+class Pipeline:
+    """
+    A chain of processing stages, each with its own worker threads
+    and a bounded input queue.  Items are submitted to the first
+    stage and flow through the rest, and submit returns a promise for
+    the output of the last stage (or for the first error raised).
+
+    pipeline = Pipeline()
+    pipeline.stage(fetch, concurrency=8)
+    pipeline.stage(transform, concurrency=2)
+    pipeline.stage(write, queue_size=4)
+    results = [pipeline.submit(url) for url in urls]
+    pipeline.close().wait()
+    """
+
+    def __init__(self):
+        self._stages = []
+        self._lock = Lock()
+        # Held while feeding the first stage, so that no item can be
+        # queued behind the stop markers put there by close.
+        self._feedLock = Lock()
+        self._started = False
+        self._closed = False
+        self._finished = Promise()
+
+    def stage(self, f, concurrency=1, queue_size=16, name=None):
+        """
+        Append a stage which calls f on each item, using the given
+        number of worker threads.  The function may return a value
+        or a promise for one.  Returns the pipeline itself, so calls
+        can be chained.
+        """
+        assert _isFunction(f)
+
+        with self._lock:
+            if self._started:
+                raise ValueError("Cannot add stages to a running pipeline")
+
+            if name is None:
+                name = getattr(f, "__name__", "stage-%d" % len(self._stages))
+
+            stage = _Stage(self, f, concurrency, queue_size, name)
+            if self._stages:
+                self._stages[-1].next = stage
+            self._stages.append(stage)
+
+        return self
+
+    def _start(self):
+        with self._lock:
+            if self._closed:
+                raise ValueError("Pipeline has been closed")
+
+            if not self._started:
+                if not self._stages:
+                    raise ValueError("Pipeline has no stages")
+
+                self._started = True
+                for stage in self._stages:
+                    stage.start()
+
+    def submit(self, item):
+        """
+        Feed an item into the first stage, blocking while its queue
+        is full.  Returns a promise for the result of the last stage.
+        """
+        self._start()
+
+        p = Promise()
+        with self._feedLock:
+            if self._closed:
+                raise ValueError("Pipeline has been closed")
+            self._stages[0].queue.put((item, p))
+        return p
+
+    def close(self):
+        """
+        Stop accepting items.  Returns a promise which is fulfilled
+        once every item already submitted has left the pipeline and
+        all of its worker threads have exited.
+        """
+        with self._feedLock:
+            if self._closed:
+                return self._finished
+
+            self._start()
+
+            self._closed = True
+            first = self._stages[0]
+            for i in range(first.concurrency):
+                first.queue.put(_STOP)
+
+        return self._finished
+
+    def _stageFinished(self, stage):
+        if stage.next is None:
+            self._finished.fulfill(None)
+        else:
+            for i in range(stage.next.concurrency):
+                stage.next.queue.put(_STOP)
+
+    def metrics(self):
+        """
+        A list with a dictionary of counters for each stage: the number
+        of items processed and failed, the current queue depth, how many
+        workers are busy, total busy time and throughput in items per
+        second since the pipeline started.
+        """
+        return [stage.metrics() for stage in self._stages]
@@ -0,0 +1,232 @@
+"""
+Admission policies for spawn.
+
+A policy decides when a spawned job may start.  Jobs which can't start
+yet are queued inside the policy (no thread is blocked waiting for
+them) and are submitted to the executor as soon as they are admitted.
+Several policies can be combined by passing a list to spawn, in which
+case a job has to be admitted by each of them in turn.
+"""
+
+from collections import deque
+from threading import Lock
+import time
+
+from aplus import Promise
+
+
+class PolicyRejected(Exception):
+    """
+    The reason a spawned job is rejected when a policy's queue is full.
+    """
+    pass
+
+
+class Policy:
+    """
+    The base class for admission policies, which keeps the queue of
+    waiting jobs and counts how many jobs were admitted and rejected.
+    At most max_queued jobs may wait to be admitted; beyond that they
+    are rejected with PolicyRejected.
+    """
+
+    def __init__(self, max_queued=None):
+        self._lock = Lock()
+        self._waiting = deque()
+        self._max_queued = max_queued
+        self._admitted = 0
+        self._rejected = 0
+
+    @property
+    def queued(self):
+        """The number of jobs waiting to be admitted."""
+        return len(self._waiting)
+
+    @property
+    def admitted(self):
+        """The number of jobs admitted so far."""
+        return self._admitted
+
+    @property
+    def rejected(self):
+        """The number of jobs rejected so far because the queue was full."""
+        return self._rejected
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": len(self._waiting),
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+            }
+
+    def _acquire(self, admit, reject, later):
+        """
+        Call admit once the job may start, or reject (with the reason)
+        if it never will.  The later function schedules a call after a
+        delay in a way that suits the executor the job will run on.
+        """
+        with self._lock:
+            # Jobs are admitted in order, so nothing jumps the queue
+            if not self._waiting and self._canAdmit():
+                self._admitted += 1
+                full = False
+            elif self._max_queued is not None and len(self._waiting) >= self._max_queued:
+                self._rejected += 1
+                full = True
+            else:
+                self._waiting.append(admit)
+                self._queued(later)
+                return
+
+        if full:
+            reject(PolicyRejected("Too many jobs waiting for %s" % type(self).__name__))
+        else:
+            admit()
+
+    def _admitWaiting(self):
+        """
+        Admit as many waiting jobs as the policy now allows.
+        """
+        admitted = []
+        with self._lock:
+            while self._waiting and self._canAdmit():
+                self._admitted += 1
+                admitted.append(self._waiting.popleft())
+
+        for admit in admitted:
+            admit()
+
+    def _canAdmit(self):
+        """
+        Whether a job may be admitted now, in which case the permit it
+        needs is taken.  Called with the lock held.
+        """
+        raise NotImplementedError()
+
+    def _queued(self, later):
+        """
+        Called, with the lock held, after a job has been queued.
+        """
+        pass
+
+    def _release(self):
+        """
+        Called when a job admitted by this policy has settled.
+        """
+        pass
+
+
+class Semaphore(Policy):
+    """
+    Allows at most n jobs to run at the same time.  The permit held by
+    a job is released when its promise is settled.
+    """
+
+    def __init__(self, n, max_queued=None):
+        assert n > 0
+
+        Policy.__init__(self, max_queued)
+        self._available = n
+
+    def _canAdmit(self):
+        if self._available > 0:
+            self._available -= 1
+            return True
+        return False
+
+    def _release(self):
+        with self._lock:
+            self._available += 1
+        self._admitWaiting()
+
+
+class RateLimiter(Policy):
+    """
+    Admits jobs at no more than rate per second on average, allowing
+    bursts of up to burst jobs at once (a token bucket).
+    """
+
+    def __init__(self, rate, burst=1, max_queued=None):
+        assert rate > 0
+        assert burst >= 1
+
+        Policy.__init__(self, max_queued)
+        self._rate = float(rate)
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._scheduled = False
+        self._later = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def _canAdmit(self):
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def _queued(self, later):
+        self._later = later
+        self._schedule()
+
+    def _schedule(self):
+        # Wake up when the next token will be available.  Called with
+        # the lock held.
+        if not self._scheduled and self._waiting:
+            self._scheduled = True
+            delay = max((1 - self._tokens) / self._rate, 0)
+            self._later(delay, self._tick)
+
+    def _tick(self):
+        with self._lock:
+            self._scheduled = False
+
+        self._admitWaiting()
+
+        with self._lock:
+            self._schedule()
+
+
+def _admit(policies, p, start, later):
+    """
+    Pass a job through each of the policies in turn, then start it.
+    Permits are released when p, the promise for the job, settles.
+    """
+    if not policies:
+        start()
+        return
+
+    first, rest = policies[0], policies[1:]
+
+    def admitted():
+        p.done(lambda v: first._release(), lambda r: first._release())
+        _admit(rest, p, start, later)
+
+    first._acquire(admitted, p.reject, later)
+
+
+def _withPolicies(policies, start, later):
+    """
+    Returns a promise for the job that start (a function returning a
+    promise) begins, once the policies (one or a list) admit it.  Any
+    delayed admissions are scheduled with later(delay, f).
+    """
+    if isinstance(policies, Policy):
+        policies = [policies]
+
+    p = Promise()
+
+    def go():
+        try:
+            p.fulfill(start())
+        except Exception as e:
+            p.reject(e)
+
+    _admit(list(policies), p, go, later)
+    return p
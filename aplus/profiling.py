@@ -0,0 +1,146 @@
+"""
+Latency profiling for chains of promises built with then.
+
+While a ChainProfiler is running, every promise created by then is
+tagged with the promise it was chained from, and each handler call
+records three intervals:
+
+* wait  - from the call to then until the parent promise settled
+* delay - from the parent settling until the handler started running
+* run   - how long the handler itself took
+
+These are aggregated per handler, keyed by its qualified name.
+"""
+
+from collections import deque
+from threading import Lock
+import time
+import weakref
+
+import aplus
+
+
+def _qualifiedName(f):
+    module = getattr(f, "__module__", None)
+    name = getattr(f, "__qualname__", None) or getattr(f, "__name__", None) or repr(f)
+    return "%s.%s" % (module, name) if module else name
+
+
+def _percentile(ordered, fraction):
+    """The nearest-rank percentile of an already sorted list."""
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def _summarize(samples):
+    ordered = sorted(samples)
+    return {
+        "p50": _percentile(ordered, 0.50),
+        "p90": _percentile(ordered, 0.90),
+        "p99": _percentile(ordered, 0.99),
+        "max": ordered[-1],
+        "mean": sum(ordered) / len(ordered),
+    }
+
+
+class _HandlerStats:
+    def __init__(self, max_samples):
+        self.count = 0
+        self.wait = deque(maxlen=max_samples)
+        self.delay = deque(maxlen=max_samples)
+        self.run = deque(maxlen=max_samples)
+
+
+class ChainProfiler:
+    """
+    An opt-in profiler for then chains.  Only one profiler can be
+    running at a time.  At most max_samples of the most recent
+    measurements are kept for each handler.
+
+    with ChainProfiler() as profiler:
+        ...
+    print(profiler.report())
+    """
+
+    def __init__(self, max_samples=10000):
+        self._max_samples = max_samples
+        self._lock = Lock()
+        self._stats = {}
+
+    def start(self):
+        if aplus._profiler is not None and aplus._profiler is not self:
+            raise ValueError("Another profiler is already running")
+        aplus._profiler = self
+        return self
+
+    def stop(self):
+        if aplus._profiler is self:
+            aplus._profiler = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._stats = {}
+
+    def _wrap(self, parent, ret, success, failure):
+        """
+        Called by then (via Promise._chain) to tag the new promise and
+        wrap its handlers with timing code.
+        """
+        created = time.monotonic()
+        ret._parent = weakref.ref(parent)
+
+        def timed(f):
+            if not aplus._isFunction(f):
+                return f
+
+            name = _qualifiedName(f)
+
+            def call(arg):
+                start = time.monotonic()
+                try:
+                    return f(arg)
+                finally:
+                    end = time.monotonic()
+                    # A parent which had already settled when then was
+                    # called didn't keep this handler waiting at all.
+                    settled = max(getattr(parent, "_settledAt", start), created)
+                    self._record(name, settled - created, start - settled, end - start)
+
+            return call
+
+        return timed(success), timed(failure)
+
+    def _record(self, name, wait, delay, run):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = _HandlerStats(self._max_samples)
+
+            stats.count += 1
+            stats.wait.append(wait)
+            stats.delay.append(delay)
+            stats.run.append(run)
+
+    def report(self):
+        """
+        A dictionary keyed by handler name, giving the number of calls
+        and the p50, p90, p99, max and mean (in seconds) of the wait,
+        delay and run intervals of each handler.
+        """
+        with self._lock:
+            items = [(name, stats.count, list(stats.wait), list(stats.delay), list(stats.run))
+                     for name, stats in self._stats.items()]
+
+        return dict((name, {
+            "count": count,
+            "wait": _summarize(wait),
+            "delay": _summarize(delay),
+            "run": _summarize(run),
+        }) for name, count, wait, delay, run in items)
@@ -0,0 +1,351 @@
+"""
+Promises which are settled by another process.
+
+A RemoteReceiver owns the local side of a connection (a
+multiprocessing Connection or a socket) and hands out RemotePromise
+objects, each with an id that can be passed to a worker process.
+The worker settles those ids through a RemoteSender on the other end
+of the connection, which batches the results into multi-message
+frames.  A thread in the local process reads the frames and settles
+the matching promises, which can then be composed with then,
+listPromise, etc. like any other promise.
+"""
+
+from threading import Condition, Lock, Thread
+import itertools
+import pickle
+import socket
+import struct
+import time
+
+from aplus import Promise
+
+
+class RemoteError(Exception):
+    """
+    Raised (as a rejection reason) when the real reason could not be
+    sent from the worker, or when the connection is lost before the
+    promise was settled.
+    """
+    pass
+
+
+class SocketChannel:
+    """
+    Adapts a stream socket to the send_bytes/recv_bytes interface of
+    a multiprocessing Connection, using length prefixed frames.
+    """
+
+    _HEADER = struct.Struct("!I")
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._send_lock = Lock()
+
+    def send_bytes(self, data):
+        with self._send_lock:
+            self._sock.sendall(self._HEADER.pack(len(data)) + data)
+
+    def _recv_exactly(self, n):
+        chunks = []
+        while n > 0:
+            chunk = self._sock.recv(min(n, 1 << 16))
+            if not chunk:
+                raise EOFError("Socket closed")
+            chunks.append(chunk)
+            n -= len(chunk)
+        return b"".join(chunks)
+
+    def recv_bytes(self):
+        size, = self._HEADER.unpack(self._recv_exactly(self._HEADER.size))
+        return self._recv_exactly(size)
+
+    def close(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+
+def _asChannel(conn):
+    if isinstance(conn, socket.socket):
+        return SocketChannel(conn)
+    return conn
+
+
+# Each message in a frame is the id of its promise, whether it was
+# fulfilled, and the length of its payload, followed by the payload
+# serialized on its own, so that one payload which can't be read
+# doesn't cost the others in the frame.
+_MESSAGE = struct.Struct("!Q?I")
+
+
+def _encodeReason(reason):
+    """
+    A description of a rejection reason, as the name of its type and
+    its message, which any serializer can handle.
+    """
+    return [type(reason).__name__, str(reason)]
+
+
+def _decodeReason(payload):
+    """
+    The rejection reason for a payload, which is either the reason
+    itself or a description of it made by _encodeReason.
+    """
+    if isinstance(payload, Exception):
+        return payload
+
+    try:
+        name, message = payload
+        return RemoteError("%s: %s" % (name, message))
+    except Exception:
+        return RemoteError("Rejected with %r" % (payload,))
+
+
+class RemotePromise(Promise):
+    """
+    A promise which will be settled by a worker process, using the
+    id it was given by its RemoteReceiver.
+    """
+
+    def __init__(self, promise_id):
+        Promise.__init__(self)
+        self.id = promise_id
+
+
+class RemoteReceiver:
+    """
+    The local end of a connection to one or more workers.  The
+    serializer is any object with dumps and loads functions (the
+    pickle module by default) and must match the one used by the
+    RemoteSender.
+    """
+
+    def __init__(self, conn, serializer=pickle):
+        self._channel = _asChannel(conn)
+        self._serializer = serializer
+        self._lock = Lock()
+        self._pending = {}
+        self._ids = itertools.count()
+        self._closed = False
+
+        self._reader = Thread(target=self._read, name="aplus-remote-receiver")
+        self._reader.daemon = True
+        self._reader.start()
+
+    def promise(self):
+        """
+        Create a new RemotePromise.  Send its id to the worker which
+        is expected to settle it.
+        """
+        with self._lock:
+            if self._closed:
+                raise RemoteError("Receiver has been closed")
+
+            p = RemotePromise(next(self._ids))
+            self._pending[p.id] = p
+            return p
+
+    @property
+    def pending(self):
+        """The number of promises still waiting to be settled."""
+        return len(self._pending)
+
+    def _read(self):
+        try:
+            self._readFrames()
+        finally:
+            self._abandon(RemoteError("Connection to worker was lost"))
+
+    def _readFrames(self):
+        loads = self._serializer.loads
+
+        while True:
+            try:
+                frame = self._channel.recv_bytes()
+            except (EOFError, OSError):
+                return
+
+            offset = 0
+            while offset < len(frame):
+                try:
+                    promise_id, ok, length = _MESSAGE.unpack_from(frame, offset)
+                except struct.error:
+                    # A corrupt frame means we have lost track of which
+                    # promises were settled, so treat it as a disconnect.
+                    return
+                start = offset + _MESSAGE.size
+                offset = start + length
+
+                with self._lock:
+                    p = self._pending.pop(promise_id, None)
+
+                if p is None:
+                    continue
+
+                try:
+                    payload = loads(frame[start:offset])
+                except Exception as e:
+                    p.reject(RemoteError("Unable to read result: %s" % (e,)))
+                    continue
+
+                try:
+                    if ok:
+                        p.fulfill(payload)
+                    else:
+                        p.reject(_decodeReason(payload))
+                except Exception as e:
+                    p.reject(e)
+
+    def _abandon(self, reason):
+        with self._lock:
+            self._closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+
+        for p in pending:
+            p.reject(reason)
+
+    def close(self):
+        """
+        Close the connection, rejecting any promises which have not
+        been settled yet.
+        """
+        try:
+            self._channel.close()
+        finally:
+            self._abandon(RemoteError("Receiver has been closed"))
+
+
+class RemoteSender:
+    """
+    The worker end of a connection to a RemoteReceiver.  Results are
+    buffered and sent as a single frame once batch_size of them have
+    accumulated, or when flush_interval seconds have passed since the
+    first of them was buffered, whichever comes first.
+    """
+
+    def __init__(self, conn, serializer=pickle, batch_size=64, flush_interval=0.01):
+        assert batch_size > 0
+
+        self._channel = _asChannel(conn)
+        self._serializer = serializer
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._buffer = []
+        self._first = None
+        self._closed = False
+        self._cond = Condition(Lock())
+        self._send_lock = Lock()
+
+        self._flusher = Thread(target=self._flushPeriodically, name="aplus-remote-sender")
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def fulfill(self, promise_id, value):
+        """Fulfill the remote promise with the given id."""
+        self._add((promise_id, True, value))
+
+    def reject(self, promise_id, reason):
+        """Reject the remote promise with the given id."""
+        assert isinstance(reason, Exception)
+
+        self._add((promise_id, False, reason))
+
+    def settle(self, promise_id, promise):
+        """
+        Settle the remote promise with the given id with the same
+        value or reason as a local promise, once it is settled.
+        """
+        promise.done(lambda v: self.fulfill(promise_id, v),
+                     lambda r: self.reject(promise_id, r))
+
+    def _add(self, message):
+        with self._cond:
+            if self._closed:
+                raise RemoteError("Sender has been closed")
+
+            self._buffer.append(message)
+            if len(self._buffer) == 1:
+                self._first = time.time()
+                self._cond.notify()
+
+            full = len(self._buffer) >= self._batch_size
+
+        if full:
+            self.flush()
+
+    def _encode(self, messages):
+        dumps = self._serializer.dumps
+        loads = self._serializer.loads
+
+        # A result which can't be serialized is sent as a description
+        # of its rejection reason (or of the failure to send its value)
+        # instead.  Reasons are also checked to deserialize, since many
+        # exceptions with their own constructors pickle but can't be
+        # rebuilt.
+        chunks = []
+        for promise_id, ok, payload in messages:
+            try:
+                data = dumps(payload)
+                if not ok:
+                    loads(data)
+            except Exception as e:
+                if ok:
+                    reason = RemoteError("Unable to send value: %s" % (e,))
+                else:
+                    reason = payload
+                ok = False
+                data = dumps(_encodeReason(reason))
+
+            chunks.append(_MESSAGE.pack(promise_id, ok, len(data)))
+            chunks.append(data)
+
+        return b"".join(chunks)
+
+    def flush(self):
+        """Send all buffered results now."""
+        # Hold the send lock while taking the buffer so that frames
+        # are sent in the order their results were buffered.
+        with self._send_lock:
+            with self._cond:
+                messages = self._buffer
+                self._buffer = []
+                self._first = None
+
+            if messages:
+                self._channel.send_bytes(self._encode(messages))
+
+    def _flushPeriodically(self):
+        while True:
+            with self._cond:
+                while not self._closed and self._first is None:
+                    self._cond.wait()
+
+                if self._closed:
+                    return
+
+                delay = self._first + self._flush_interval - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+            try:
+                self.flush()
+            except (EOFError, OSError):
+                return
+            except Exception:
+                # The batch is lost, but later ones may still be sent.
+                pass
+
+    def close(self):
+        """Send any buffered results and close the connection."""
+        try:
+            self.flush()
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify()
+            self._channel.close()
@@ -0,0 +1,207 @@
+"""
+Recording of the causality graph between promises, for viewing in
+chrome://tracing or Perfetto.
+
+While a TraceRecorder is running it records when promises are created
+and settled, when the handlers registered by then and listPromise run
+and when functions passed to spawn run, each on the thread where it
+happened.  Handlers are linked by flow arrows to the settlement of the
+promise which caused them to run (and spawned functions to the call
+to spawn), so the trace shows which promise resolved which, across
+threads.
+
+Events are kept in a ring buffer, so only the most recent ones are
+retained and memory use stays bounded however long it runs.
+"""
+
+from collections import deque
+from threading import Lock, current_thread, get_ident
+import itertools
+import json
+import os
+import time
+
+import aplus
+
+
+def _handlerName(kind, f):
+    if f is None or not aplus._isFunction(f):
+        return kind
+    name = getattr(f, "__qualname__", None) or getattr(f, "__name__", None) or repr(f)
+    return "%s %s" % (kind, name)
+
+
+class TraceRecorder:
+    """
+    Records promise events into a ring buffer of the given capacity.
+    Only one recorder can be running at a time.
+
+    recorder = TraceRecorder().start()
+    ...
+    recorder.export("trace.json")
+    """
+
+    def __init__(self, capacity=100000):
+        self._events = deque(maxlen=capacity)
+        self._ids = itertools.count(1)
+        self._flows = itertools.count(1)
+        self._threads = {}
+        self._lock = Lock()
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+
+    def start(self):
+        if aplus._tracer is not None and aplus._tracer is not self:
+            raise ValueError("Another trace recorder is already running")
+        aplus._tracer = self
+        return self
+
+    def stop(self):
+        if aplus._tracer is self:
+            aplus._tracer = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def clear(self):
+        self._events.clear()
+
+    def _now(self):
+        """Microseconds since the recorder was created."""
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def _tid(self):
+        tid = get_ident()
+        if tid not in self._threads:
+            with self._lock:
+                self._threads[tid] = current_thread().name
+        return tid
+
+    def _id(self, p):
+        ident = getattr(p, "_traceId", None)
+        if ident is None:
+            ident = p._traceId = next(self._ids)
+        return ident
+
+    def _slice(self, name, ts, dur, tid, args):
+        self._events.append({
+            "name": name, "cat": "promise", "ph": "X",
+            "ts": ts, "dur": dur, "pid": self._pid, "tid": tid, "args": args,
+        })
+
+    def _flow(self, source, ts, tid):
+        """
+        Draw an arrow from where source (a (ts, tid) pair) happened to
+        the slice on thread tid which encloses ts.
+        """
+        if source is None:
+            return
+
+        flow = next(self._flows)
+        self._events.append({
+            "name": "causes", "cat": "promise", "ph": "s", "id": flow,
+            "ts": source[0], "pid": self._pid, "tid": source[1],
+        })
+        self._events.append({
+            "name": "causes", "cat": "promise", "ph": "f", "bp": "e", "id": flow,
+            "ts": ts, "pid": self._pid, "tid": tid,
+        })
+
+    # The following are called from the aplus package itself
+
+    def _created(self, p):
+        self._events.append({
+            "name": "create", "cat": "promise", "ph": "i", "s": "t",
+            "ts": self._now(), "pid": self._pid, "tid": self._tid(),
+            "args": {"promise": self._id(p)},
+        })
+
+    def _settled(self, p, cause=None):
+        ts = self._now()
+        tid = self._tid()
+        p._traceSettle = (ts, tid)
+
+        name = "fulfill" if p._state == aplus.Promise.FULFILLED else "reject"
+        self._slice(name, ts, 1, tid, {"promise": self._id(p)})
+
+        if cause is not None:
+            self._flow(getattr(cause, "_traceSettle", None), ts, tid)
+
+    def _wrap(self, parent, child, handler, f):
+        """
+        Wrap a callback registered on parent (by then, listPromise...)
+        so that it records a slice when it runs, with an arrow from the
+        settlement of parent.  The handler is either the function passed
+        to then or a name for the slice.
+        """
+        if isinstance(handler, str):
+            name = handler
+        else:
+            name = _handlerName("then", handler)
+        args = {"parent": self._id(parent), "promise": self._id(child)}
+
+        def call(arg):
+            tid = self._tid()
+            start = self._now()
+            try:
+                return f(arg)
+            finally:
+                self._slice(name, start, max(self._now() - start, 1), tid, args)
+                self._flow(getattr(parent, "_traceSettle", None), start, tid)
+
+        return call
+
+    def _spawned(self, p, f):
+        ts = self._now()
+        tid = self._tid()
+        p._traceSpawn = (ts, tid)
+        self._slice(_handlerName("spawn", f), ts, 1, tid, {"promise": self._id(p)})
+
+    def _wrapSpawned(self, p, f):
+        name = _handlerName("run", f)
+        args = {"promise": self._id(p)}
+
+        def run():
+            tid = self._tid()
+            start = self._now()
+            try:
+                return f()
+            finally:
+                self._slice(name, start, max(self._now() - start, 1), tid, args)
+                self._flow(getattr(p, "_traceSpawn", None), start, tid)
+
+        return run
+
+    def events(self):
+        """
+        The recorded events in Chrome trace event format, sorted by
+        time and preceded by metadata naming the threads.
+        """
+        events = sorted(list(self._events), key=lambda e: e["ts"])
+
+        with self._lock:
+            threads = list(self._threads.items())
+
+        metadata = [{
+            "name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid,
+            "args": {"name": name},
+        } for tid, name in threads]
+
+        return metadata + events
+
+    def export(self, target):
+        """
+        Write the trace as Chrome trace JSON to target, which is either
+        a path or a file-like object.
+        """
+        trace = {"traceEvents": self.events(), "displayTimeUnit": "ms"}
+
+        if hasattr(target, "write"):
+            json.dump(trace, target)
+        else:
+            with open(target, "w") as f:
+                json.dump(trace, f)
@@ -0,0 +1,141 @@
+# Micro-benchmarks for the hot paths of the aplus package.  These
+# are not part of the test suite; run them directly with:
+#
+#   python Benchmarks.py
+
+import timeit
+
+import aplus
+from aplus import Promise
+
+
+def _probeIsPromise(obj):
+    """
+    The attribute probing classification used before thenable
+    kinds were cached per type, kept here for comparison.
+    """
+    return isinstance(obj, Promise) or (
+        hasattr(obj, "done") and aplus._isFunction(getattr(obj, "done"))) or (
+        hasattr(obj, "then") and aplus._isFunction(getattr(obj, "then")))
+
+
+class Plain(object):
+    pass
+
+
+def report(name, seconds, number):
+    print("%-40s %8.1f ns/op" % (name, seconds / number * 1e9))
+
+
+def bench_thenable_classification(number=1000000):
+    for label, value in [("int", 5), ("dict", {"a": 1}), ("object", Plain())]:
+        t = timeit.timeit(lambda: _probeIsPromise(value), number=number)
+        report("probe classification (%s)" % label, t, number)
+        t = timeit.timeit(lambda: aplus._isPromise(value), number=number)
+        report("cached classification (%s)" % label, t, number)
+
+
+def bench_fulfill(number=200000):
+    for label, value in [("int", 5), ("dict", {"a": 1}), ("object", Plain())]:
+        t = timeit.timeit(lambda: Promise().fulfill(value), number=number)
+        report("Promise().fulfill(%s)" % label, t, number)
+
+
+def bench_inline(steps=1000, number=20):
+    from aplus import inline
+
+    def chained():
+        source = Promise()
+        p = source
+        for i in range(steps):
+            p = p.then(lambda v, i=i: v + i)
+        source.fulfill(0)
+        return p
+
+    @inline
+    def sequential():
+        total = 0
+        for i in range(steps):
+            source = Promise()
+            source.fulfill(i)
+            total += yield source
+        return total
+
+    t = timeit.timeit(chained, number=number)
+    report("then chain (%d steps)" % steps, t, number * steps)
+    t = timeit.timeit(sequential, number=number)
+    report("@inline generator (%d steps)" % steps, t, number * steps)
+
+
+def bench_bulk(size=1000, number=20):
+    from aplus import fulfill_many
+
+    def setup():
+        promises = [Promise() for i in range(size)]
+        for p in promises:
+            p.done(lambda v: None)
+        return promises
+
+    def one_by_one():
+        for p in setup():
+            p.fulfill(1)
+
+    def bulk():
+        fulfill_many((p, 1) for p in setup())
+
+    t = timeit.timeit(one_by_one, number=number)
+    report("fulfill one by one (%d)" % size, t, number * size)
+    t = timeit.timeit(bulk, number=number)
+    report("fulfill_many (%d)" % size, t, number * size)
+
+
+def _twoPassDictPromise(m):
+    """
+    The dictPromise implementation which re-read every value once the
+    last one arrived, kept here for comparison.
+    """
+    ret = Promise()
+    counter = aplus.CountdownLatch(len(m))
+
+    def handleSuccess(_):
+        if counter.dec() == 0:
+            value = {}
+
+            for k in m:
+                value[k] = m[k].value
+
+            ret.fulfill(value)
+
+    for p in m.values():
+        assert aplus._isPromise(p)
+
+        aplus._promisify(p).done(handleSuccess, ret.reject)
+
+    return ret
+
+
+def bench_dict_promise(size=100000, number=3):
+    from aplus import dictPromise
+
+    def run(implementation):
+        # Only time aggregation and settlement, not creating promises
+        m = dict((i, Promise()) for i in range(size))
+        start = timeit.default_timer()
+        result = implementation(m)
+        for i, p in m.items():
+            p.fulfill(i)
+        assert len(result.value) == size
+        return timeit.default_timer() - start
+
+    for label, implementation in [("two pass", _twoPassDictPromise),
+                                  ("streaming", dictPromise)]:
+        t = sum(run(implementation) for i in range(number))
+        report("%s dictPromise (%d keys)" % (label, size), t, number * size)
+
+
+if __name__ == "__main__":
+    bench_thenable_classification()
+    bench_fulfill()
+    bench_inline()
+    bench_bulk()
+    bench_dict_promise()
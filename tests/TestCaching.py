@@ -0,0 +1,173 @@
+# Tests for the on-disk result cache
+
+from nose.tools import assert_equals, assert_is_instance
+from aplus import PriorityExecutor, disk_cache
+from aplus.caching import _stores
+from threading import Event
+import errno
+import os
+import shutil
+import tempfile
+
+
+def test_disk_cache():
+    d = tempfile.mkdtemp()
+    path = os.path.join(d, "cache")
+    executor = PriorityExecutor(max_workers=4)
+    calls = []
+    gate = Event()
+
+    def square(x):
+        gate.wait(5.0)
+        calls.append(x)
+        return x * x
+
+    try:
+        cached = disk_cache(path, executor=executor)(square)
+
+        # Concurrent misses share one run
+        p1 = cached(3)
+        p2 = cached(3)
+        gate.set()
+        assert_equals(9, p1.get(5.0))
+        assert_equals(9, p2.get(5.0))
+        assert_equals([3], calls)
+
+        # Hits are already fulfilled
+        p3 = cached(3)
+        assert p3.isFulfilled
+        assert_equals(9, p3.value)
+        assert_equals([3], calls)
+        assert_equals(1, cached.cache_info()["hits"])
+        cached.cache_close()
+
+        # The values survive reopening the file
+        reopened = disk_cache(path, executor=executor)(square)
+        assert_equals(9, reopened(3).value)
+        assert_equals(16, reopened(4).get(5.0))
+        assert_equals([3, 4], calls)
+        assert_equals(2, reopened.cache_info()["entries"])
+        reopened.cache_close()
+    finally:
+        executor.shutdown()
+        shutil.rmtree(d)
+
+
+def test_disk_cache_compaction():
+    d = tempfile.mkdtemp()
+    path = os.path.join(d, "cache")
+    executor = PriorityExecutor(max_workers=1)
+
+    def blob(i):
+        return bytes(1000)
+
+    try:
+        cached = disk_cache(path, max_bytes=5000, executor=executor)(blob)
+        for i in range(4):
+            cached(i).get(5.0)
+        # Using a value keeps it through compaction
+        assert cached(0).isFulfilled
+        cached(4).get(5.0)
+
+        info = cached.cache_info()
+        assert info["bytes"] <= 2500
+        assert_equals(info["bytes"], os.path.getsize(path))
+        assert cached(4).isFulfilled
+        assert cached(0).isFulfilled
+        assert cached(1).get(5.0) is not None
+        assert not cached(1).isPending
+        cached.cache_close()
+    finally:
+        executor.shutdown()
+        shutil.rmtree(d)
+
+
+def _unpickleable():
+    raise ValueError("Can't rebuild")
+
+
+class Brittle:
+    """A value which pickles but fails to unpickle."""
+
+    def __reduce__(self):
+        return _unpickleable, ()
+
+
+def test_disk_cache_misses():
+    d = tempfile.mkdtemp()
+    path = os.path.join(d, "cache")
+    executor = PriorityExecutor(max_workers=1)
+    calls = []
+
+    def make(kind, i):
+        calls.append((kind, i))
+        if kind == "large":
+            return bytes(4900)
+        if kind == "brittle":
+            return Brittle()
+        return i
+
+    try:
+        cached = disk_cache(path, max_bytes=5000, executor=executor)(make)
+
+        # A value too large to survive compaction doesn't take the
+        # smaller ones with it
+        for i in range(3):
+            cached("small", i).get(5.0)
+        cached("large", 0).get(5.0)
+        assert_equals(3, cached.cache_info()["entries"])
+        assert_equals(2, cached("small", 2).value)
+
+        # A stored value which can't be unpickled is a miss
+        assert_is_instance(cached("brittle", 0).get(5.0), Brittle)
+        assert_is_instance(cached("brittle", 0).get(5.0), Brittle)
+        assert_equals(2, calls.count(("brittle", 0)))
+
+        # So is everything once the file is closed
+        cached.cache_close()
+        assert_equals(1, cached("small", 1).get(5.0))
+        assert_equals(2, calls.count(("small", 1)))
+    finally:
+        executor.shutdown()
+        shutil.rmtree(d)
+
+
+def test_disk_cache_shared_and_failing():
+    d = tempfile.mkdtemp()
+    path = os.path.join(d, "cache")
+    executor = PriorityExecutor(max_workers=1)
+
+    def double(x):
+        return 2 * x
+
+    def triple(x):
+        return 3 * x
+
+    try:
+        # Functions cached in the same file share its index
+        cached2 = disk_cache(path, executor=executor)(double)
+        cached3 = disk_cache(os.path.join(d, ".", "cache"), executor=executor)(triple)
+        assert_equals(2, cached2(1).get(5.0))
+        assert_equals(3, cached3(1).get(5.0))
+        assert_equals(2, cached2.cache_info()["entries"])
+        assert_equals(os.path.getsize(path), cached3.cache_info()["bytes"])
+
+        # Closing one leaves the file open for the other
+        cached2.cache_close()
+        assert cached3(1).isFulfilled
+
+        # A value which can't be written is still delivered
+        def full(data):
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        store = _stores[os.path.realpath(path)][0]
+        size = store.size
+        store._file.write = full
+        assert_equals(6, cached3(2).get(5.0))
+        assert_equals(6, cached3(2).get(5.0))
+        assert_equals(size, store.size)
+        cached3.cache_close()
+        assert_equals(size, os.path.getsize(path))
+    finally:
+        executor.shutdown()
+        shutil.rmtree(d)
@@ -0,0 +1,311 @@
+# Tests for the executor behind spawn
+
+from nose.tools import assert_equals, assert_raises
+from aplus import (PriorityExecutor, PRIORITY_HIGH, PRIORITY_NORMAL,
+                   PRIORITY_LOW, listPromise)
+from threading import Event
+import time
+
+
+def blocker(gate, started=None):
+    def job():
+        if started is not None:
+            started.set()
+        gate.wait(5.0)
+    return job
+
+
+def test_priority_order():
+    executor = PriorityExecutor(max_workers=1)
+    gate = Event()
+    order = []
+
+    executor.submit(blocker(gate))
+    promises = [executor.submit(lambda p=p: order.append(p), p)
+                for p in [PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH, PRIORITY_LOW]]
+    time.sleep(0.1)
+    gate.set()
+
+    listPromise(promises).wait(5.0)
+    assert_equals([PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW, PRIORITY_LOW], order)
+    executor.shutdown()
+
+
+def test_reserved_capacity():
+    executor = PriorityExecutor(max_workers=2, reserved={PRIORITY_HIGH: 1})
+    gate = Event()
+
+    bulk = [executor.submit(blocker(gate), PRIORITY_LOW) for i in range(2)]
+    time.sleep(0.1)
+
+    # The second bulk job is held back to keep a worker for urgent work
+    stats = executor.lane_stats()
+    assert_equals(1, stats[PRIORITY_LOW]["started"])
+    assert_equals(1, stats[PRIORITY_LOW]["queued"])
+
+    urgent = executor.submit(lambda: "urgent", PRIORITY_HIGH)
+    assert_equals("urgent", urgent.get(1.0))
+    assert bulk[1].isPending
+
+    gate.set()
+    listPromise(bulk).wait(5.0)
+    assert all(p.isFulfilled for p in bulk)
+    executor.shutdown()
+
+
+def test_starvation_protection():
+    executor = PriorityExecutor(max_workers=1, max_wait=0.1)
+    gate = Event()
+    order = []
+
+    executor.submit(blocker(gate), PRIORITY_HIGH)
+    low = executor.submit(lambda: order.append("low"), PRIORITY_LOW)
+    time.sleep(0.2)
+    high = [executor.submit(lambda: order.append("high"), PRIORITY_HIGH) for i in range(3)]
+    gate.set()
+
+    listPromise([low] + high).wait(5.0)
+    assert_equals(["low", "high", "high", "high"], order)
+
+    stats = executor.lane_stats()
+    assert stats[PRIORITY_LOW]["max_wait"] >= 0.2
+    assert_equals(4, stats[PRIORITY_HIGH]["submitted"])
+    executor.shutdown()
+
+
+def test_shutdown():
+    executor = PriorityExecutor(max_workers=2)
+    p = executor.submit(lambda: 5)
+    executor.shutdown()
+    assert_equals(5, p.value)
+    assert_raises(RuntimeError, executor.submit, lambda: 6)
+
+
+def test_deadline():
+    from aplus import DeadlineExceeded
+
+    executor = PriorityExecutor(max_workers=1)
+    gate = Event()
+    ran = []
+
+    executor.submit(blocker(gate))
+    stale = executor.submit(lambda: ran.append("stale"), deadline=time.monotonic() + 0.05)
+    fresh = executor.submit(lambda: ran.append("fresh"), deadline=time.monotonic() + 5.0)
+    time.sleep(0.1)
+    gate.set()
+
+    listPromise(fresh).wait(5.0)
+    assert_equals(["fresh"], ran)
+    assert stale.isRejected
+    assert isinstance(stale.reason, DeadlineExceeded)
+    assert_equals(1, executor.lane_stats()[PRIORITY_NORMAL]["expired"])
+    executor.shutdown()
+
+
+def test_spawn_deadline():
+    from aplus import DeadlineExceeded, spawn
+
+    ran = []
+    p = spawn(lambda: ran.append(1), deadline=time.monotonic() - 1.0)
+
+    try:
+        import gevent
+
+        gevent.sleep(0.1)
+    except ImportError:
+        time.sleep(0.1)
+
+    assert_equals([], ran)
+    assert isinstance(p.reason, DeadlineExceeded)
+
+
+def test_spawn_reserved_worker():
+    try:
+        import gevent
+
+        # Greenlets are not pooled, so there is no executor to test
+        return
+    except ImportError:
+        pass
+
+    from aplus import executor, spawn
+
+    gate = Event()
+    bulk = [spawn(blocker(gate), PRIORITY_LOW) for i in range(7)]
+    time.sleep(0.1)
+
+    # The bulk jobs get five workers, leaving one free for urgent ones
+    assert_equals(5, executor.stats()["active"])
+    assert_equals(1, spawn(lambda: 1, PRIORITY_HIGH).get(1.0))
+
+    gate.set()
+    listPromise(bulk).wait(5.0)
+    assert executor._max_wait is not None
+
+
+def test_semaphore_policy():
+    from aplus import PolicyRejected, Semaphore
+
+    executor = PriorityExecutor(max_workers=5)
+    policy = Semaphore(2, max_queued=3)
+    gate = Event()
+    running = []
+    peak = []
+
+    def job():
+        running.append(1)
+        peak.append(len(running))
+        gate.wait(5.0)
+        running.pop()
+
+    promises = [executor.submit(job, policy=policy) for i in range(6)]
+    time.sleep(0.1)
+
+    assert_equals(2, len(running))
+    assert_equals(3, policy.queued)
+    assert_equals(2, policy.admitted)
+    assert_equals(1, policy.rejected)
+    assert isinstance(promises[5].reason, PolicyRejected)
+
+    # Waiting for admission ties up no workers
+    assert_equals("free", executor.submit(lambda: "free").get(1.0))
+
+    gate.set()
+    listPromise(promises[:5]).wait(5.0)
+    assert all(p.isFulfilled for p in promises[:5])
+    assert_equals(2, max(peak))
+    assert_equals({"queued": 0, "admitted": 5, "rejected": 1}, policy.stats())
+    executor.shutdown()
+
+
+def test_rate_limiter_policy():
+    from aplus import RateLimiter, Semaphore
+
+    executor = PriorityExecutor(max_workers=5)
+    limiter = RateLimiter(rate=20, burst=2)
+    started = []
+
+    start = time.monotonic()
+    promises = [executor.submit(lambda: started.append(time.monotonic() - start),
+                                policy=[limiter, Semaphore(3)])
+                for i in range(6)]
+    listPromise(promises).wait(5.0)
+
+    assert all(p.isFulfilled for p in promises)
+    started.sort()
+    assert started[1] < 0.05
+    # The remaining four are spaced out at 20 per second
+    assert started[5] >= 0.18
+    assert_equals(6, limiter.admitted)
+    executor.shutdown()
+
+
+def test_spawn_policy():
+    from aplus import Semaphore, spawn
+
+    policy = Semaphore(1)
+    promises = [spawn(lambda i=i: i, policy=policy) for i in range(3)]
+
+    try:
+        import gevent
+
+        gevent.sleep(0.1)
+    except ImportError:
+        time.sleep(0.1)
+
+    assert_equals([0, 1, 2], [p.value for p in promises])
+    assert_equals(3, policy.admitted)
+
+
+def test_keyed_executor():
+    from aplus import KeyedExecutor
+
+    pool = PriorityExecutor(max_workers=4)
+    keyed = KeyedExecutor(pool)
+    gate = Event()
+    order = []
+
+    def job(key, i):
+        def run():
+            if i == 0:
+                gate.wait(5.0)
+            order.append((key, i))
+            if i == 1 and key == "a":
+                raise Exception("Error")
+            return i
+        return run
+
+    promises = [keyed.submit(key, job(key, i)) for i in range(3) for key in "ab"]
+    assert_equals(2, keyed.active_keys)
+
+    # Nothing for either key runs past the blocked first jobs, while
+    # another key proceeds in parallel.
+    assert_equals(7, keyed.submit("c", lambda: 7).get(5.0))
+    time.sleep(0.1)
+    assert_equals([], order)
+    gate.set()
+
+    listPromise([p.then(None, lambda r: None) for p in promises]).wait(5.0)
+    assert_equals([0, 1, 2], [i for k, i in order if k == "a"])
+    assert_equals([0, 1, 2], [i for k, i in order if k == "b"])
+    assert promises[2].isRejected
+    assert_equals(2, promises[5].value)
+
+    # Idle keys are dropped
+    time.sleep(0.1)
+    assert_equals(0, keyed.active_keys)
+    pool.shutdown()
+
+
+def test_executor_stats():
+    from aplus import Semaphore
+
+    executor = PriorityExecutor(max_workers=2)
+    gate = Event()
+    started = Event()
+    exported = []
+    executor.set_exporter(exported.append, interval=0.05)
+
+    def fail():
+        raise Exception("Error")
+
+    policy = Semaphore(1, max_queued=0)
+    held_started = Event()
+    running = executor.submit(blocker(gate, started))
+    held = executor.submit(blocker(gate, held_started), policy=policy)
+    refused = executor.submit(lambda: None, policy=policy)
+    started.wait(5.0)
+    held_started.wait(5.0)
+    queued = [executor.submit(lambda: time.sleep(0.05), PRIORITY_LOW),
+              executor.submit(fail, PRIORITY_LOW)]
+    assert refused.isRejected
+    time.sleep(0.2)
+
+    stats = executor.stats()
+    assert_equals(2, stats["workers"])
+    assert_equals(2, stats["active"])
+    assert_equals(2, stats["queued"])
+    assert_equals(1, stats["rejected"])
+    assert_equals(2, stats["lanes"][PRIORITY_LOW]["queued"])
+    assert len(exported) >= 2
+
+    gate.set()
+    listPromise([running, held] + queued).wait(5.0)
+    executor.shutdown()
+    assert_raises(RuntimeError, executor.submit, lambda: None)
+
+    stats = executor.stats()
+    assert_equals(4, stats["submitted"])
+    assert_equals(4, stats["completed"])
+    assert_equals(1, stats["failed"])
+    assert_equals(2, stats["rejected"])
+    assert_equals(0, stats["active"])
+    assert stats["max_run"] >= 0.05
+    assert stats["max_wait"] >= 0.2
+    assert_equals(stats["lanes"], executor.lane_stats())
+
+    # The final snapshot is exported on shutdown, and no more after
+    count = len(exported)
+    assert_equals(0, exported[-1]["queued"])
+    time.sleep(0.15)
+    assert_equals(count, len(exported))
@@ -375,3 +375,574 @@ def test_then_all():
     assert_equals(results[0].value, 1)
     assert_equals(results[1].value, 1)
     assert_equals(results[2].value, 2)
+
+
+def test_use_gevent():
+    try:
+        import gevent
+    except ImportError:
+        return
+
+    from aplus import use_gevent
+
+    use_gevent()
+    try:
+        results = []
+
+        p = Promise()
+        p.done(results.append)
+        p.fulfill(5)
+        p.done(results.append)
+
+        # Callbacks are delivered by the hub, in registration order
+        assert_equals([], results)
+        gevent.sleep(0)
+        assert_equals([5, 5], results)
+
+        # Waiting only blocks the current greenlet
+        p1 = spawn(lambda: 7)
+        p2 = p1.then(lambda v: v * 2)
+        assert_equals(14, p2.get(timeout=1.0))
+
+        p3 = Promise()
+        gevent.spawn_later(0.1, p3.reject, ValueError("Boom"))
+        assert_raises(ValueError, p3.get, 1.0)
+
+        # Handlers may wait cooperatively themselves
+        other = Promise()
+        gevent.spawn_later(0.1, other.fulfill, 3)
+        p4 = spawn(lambda: 1).then(lambda v: v + other.get(1.0))
+        assert_equals(4, p4.get(1.0))
+
+        # Promises settled from another thread are handed to the hub
+        p5 = Promise()
+        p6 = p5.then(lambda v: v + 1)
+        t = Thread(target=p5.fulfill, args=(1,))
+        t.start()
+        t.join()
+        assert_equals(2, p6.get(1.0))
+
+        p7 = Promise()
+        t = Thread(target=p7.reject, args=(ValueError("Boom"),))
+        t.start()
+        t.join()
+        assert_raises(ValueError, p7.get, 1.0)
+    finally:
+        use_gevent(False)
+
+
+def test_thenable_classification():
+    from aplus import _isPromise
+
+    class DoneOnly(object):
+        def done(self, s=None, f=None):
+            s(3)
+
+    class Proxy(object):
+        def __init__(self, target):
+            self._target = target
+
+        def __getattr__(self, name):
+            return getattr(self._target, name)
+
+    for value in [None, 5, 5.0, "5", [], (), {}, set()]:
+        assert not _isPromise(value)
+
+    assert _isPromise(Promise())
+    assert _isPromise(FakePromise())
+    assert _isPromise(DoneOnly())
+    assert _isPromise(Proxy(DoneOnly()))
+    assert not _isPromise(Proxy(5))
+
+    p = Promise()
+    p.fulfill(DoneOnly())
+    assert_equals(3, p.value)
+
+    p = Promise()
+    p.fulfill(Proxy(DoneOnly()))
+    assert_equals(3, p.value)
+
+
+def test_thenable_instance_attributes():
+    from types import SimpleNamespace
+    from aplus import _isPromise
+
+    class Plain(object):
+        pass
+
+    # Instances of the same type may or may not be thenable
+    assert not _isPromise(Plain())
+    thenable = Plain()
+    thenable.then = lambda s, f: s(7)
+    assert _isPromise(thenable)
+
+    assert not _isPromise(SimpleNamespace())
+    p = Promise()
+    p.fulfill(SimpleNamespace(done=lambda s, f: s(6)))
+    assert_equals(6, p.value)
+
+    d = dictPromise({"a": SimpleNamespace(done=lambda s, f: s(6)), "b": thenable})
+    assert_equals({"a": 6, "b": 7}, d.value)
+
+
+def test_adoption_chain_collapses():
+    import gc
+    import weakref
+
+    sources = []
+    refs = []
+
+    def step(n):
+        s = Promise()
+        sources.append(s)
+        ret = s.then(lambda v: step(n - 1) if n > 0 else v)
+        refs.append(weakref.ref(ret))
+        return ret
+
+    outer = step(1000)
+    results = []
+    outer.done(results.append)
+    both = listPromise(outer, Promise.fulfilled(1))
+
+    for i in range(500):
+        sources.pop(0).fulfill(i)
+
+    # Only the outermost promise and the current innermost one survive
+    gc.collect()
+    assert_equals(2, len([r for r in refs if r() is not None]))
+    assert outer.isPending
+
+    while sources:
+        sources.pop(0).fulfill("done")
+
+    assert outer.isFulfilled
+    assert_equals("done", outer.value)
+    assert_equals(["done"], results)
+    assert_equals(["done", 1], both.value)
+
+
+def test_adoption_rejection():
+    p1 = Promise()
+    p2 = Promise()
+    p3 = Promise()
+    p1.fulfill(p2)
+    p2.fulfill(p3)
+    after = p1.then(None, lambda r: str(r))
+
+    # A promise which has adopted another ignores further settlement
+    p1.reject(Exception("Ignored"))
+    assert p1.isPending
+
+    p3.reject(Exception("Error"))
+    assert p1.isRejected
+    assert p2.isRejected
+    assert_exception(p1.reason, Exception, "Error")
+    assert_equals("Error", after.value)
+
+    p4 = p1.then(None, lambda r: "late")
+    assert_equals("late", p4.value)
+
+
+def test_adoption_cycle():
+    p1 = Promise()
+    p2 = Promise()
+    p1.fulfill(p2)
+    p2.fulfill(p1)
+    assert p2.isRejected
+    assert p1.isRejected
+    assert_is_instance(p1.reason, TypeError)
+
+
+def test_inline():
+    from aplus import inline
+
+    @inline
+    def sequence(a):
+        x = yield Promise.fulfilled(a)
+        y = yield df(x + 1, 0.05)
+        z = yield y + 1
+        try:
+            yield dr(ValueError("Bad"), 0.05)
+        except ValueError as e:
+            message = str(e)
+        return [x, y, z, message]
+
+    assert_equals([1, 2, 3, "Bad"], sequence(1).get(timeout=1.0))
+
+    @inline
+    def failing():
+        yield Promise.fulfilled(1)
+        raise ValueError("Failed")
+
+    p = failing()
+    assert p.isRejected
+    assert_exception(p.reason, ValueError, "Failed")
+
+    @inline
+    def not_a_generator(v):
+        return v * 2
+
+    assert_equals(10, not_a_generator(5).value)
+
+
+def test_inline_settled_steps():
+    from aplus import inline
+
+    @inline
+    def count(n):
+        total = 0
+        for i in range(n):
+            total += yield Promise.fulfilled(i)
+        return total
+
+    # Settled promises are resumed iteratively, without recursion
+    assert_equals(sum(range(10000)), count(10000).value)
+
+
+def test_fulfill_many():
+    from aplus import fulfill_many
+
+    promises = [Promise() for i in range(5)]
+    seen = []
+
+    def check(v):
+        # Every promise is settled before any callback runs
+        seen.append([p.isFulfilled for p in promises])
+
+    for p in promises:
+        p.done(check)
+
+    inner = Promise()
+    adopting = Promise()
+    fulfill_many([(p, i) for i, p in enumerate(promises)] + [(adopting, inner)])
+
+    assert_equals([0, 1, 2, 3, 4], [p.value for p in promises])
+    assert_equals([[True] * 5] * 5, seen)
+    assert adopting.isPending
+    inner.fulfill("inner")
+    assert_equals("inner", adopting.value)
+
+    # Invalid pairs are found before anything is settled
+    p1 = Promise()
+    p2 = Promise()
+    assert_raises(TypeError, fulfill_many, [(p1, 1), (p2, p2)])
+    assert p1.isPending
+
+    # A failure part way still runs the callbacks of those settled
+    chained = p1.then(lambda v: v + 1)
+    assert_raises(AttributeError, fulfill_many, [(p1, 1), (None, 2)])
+    assert_equals(2, chained.get(1.0))
+
+
+def test_reject_many():
+    from aplus import reject_many
+
+    promises = [Promise() for i in range(3)]
+    chained = [p.then(None, lambda r: str(r)) for p in promises]
+    promises[1].fulfill("first")
+    reject_many([(p, Exception("Error %d" % i)) for i, p in enumerate(promises)])
+
+    assert promises[0].isRejected
+    assert promises[1].isFulfilled
+    assert_equals(["Error 0", "first", "Error 2"], [p.value for p in chained])
+
+    p = Promise()
+    assert_raises(AssertionError, reject_many, [(p, Exception("Error")), (Promise(), "Error")])
+    assert p.isPending
+
+
+def test_done_all_settled():
+    results = []
+
+    p = Promise.fulfilled(3)
+    p.done_all(results.append, (results.append, None), {'failure': results.append})
+    assert_equals([3, 3], results)
+
+    p = Promise.rejected(Exception("Error"))
+    values = p.then_all(lambda v: v, (None, lambda r: "handled"))
+    assert values[0].isRejected
+    assert_equals("handled", values[1].value)
+
+
+def test_gather_array():
+    from aplus import gather_array
+
+    promises = [Promise() for i in range(4)]
+    pa = gather_array(promises, dtype="float64")
+    for i in reversed(range(4)):
+        assert pa.isPending
+        promises[i].fulfill(i * 0.5)
+
+    assert_equals([0.0, 0.5, 1.0, 1.5], list(pa.value))
+    assert_equals(0, len(gather_array([]).value))
+
+    p = Promise()
+    pa = gather_array([Promise.fulfilled(1), p], dtype="int32")
+    p.fulfill("not a number")
+    assert pa.isRejected
+
+    pa = gather_array([Promise.fulfilled(1), Promise.rejected(Exception("Error"))])
+    assert_exception(pa.reason, Exception, "Error")
+
+
+def test_gather_array_fallback():
+    import array
+    import sys
+    from aplus import gather_array
+
+    saved = sys.modules.get("numpy")
+    sys.modules["numpy"] = None
+    try:
+        pa = gather_array([Promise.fulfilled(2), Promise.fulfilled(3)], dtype="int64")
+    finally:
+        if saved is None:
+            del sys.modules["numpy"]
+        else:
+            sys.modules["numpy"] = saved
+
+    assert_is_instance(pa.value, array.array)
+    assert_equals([2, 3], list(pa.value))
+
+
+def test_dict_promise_streaming():
+    class Thenable(object):
+        def __init__(self):
+            self.callbacks = []
+
+        def then(self, s=None, f=None):
+            self.callbacks.append(s)
+
+    p1 = Promise()
+    t = Thenable()
+    arrived = []
+
+    pd = dictPromise({"a": p1, "b": t}, on_item=lambda k, v: arrived.append((k, v)))
+    t.callbacks[0](10)
+    assert_equals([("b", 10)], arrived)
+    assert pd.isPending
+    p1.fulfill(5)
+    assert_equals([("b", 10), ("a", 5)], arrived)
+    assert_equals({"a": 5, "b": 10}, pd.value)
+    assert_equals(["a", "b"], list(pd.value))
+
+    def fail(k, v):
+        raise ValueError("Stop")
+
+    pd = dictPromise({"a": Promise.fulfilled(1)}, on_item=fail)
+    assert_exception(pd.reason, ValueError, "Stop")
+
+
+def test_progress():
+    seen = []
+    p = Promise()
+    p.on_progress(lambda v: seen.append(("progress", v)))
+    p.done(lambda v: seen.append(("done", v)))
+
+    p.notify(1)
+    p.notify(2)
+    p.fulfill(3)
+    p.notify(4)
+    assert_equals([("progress", 1), ("progress", 2), ("done", 3)], seen)
+
+
+def test_progress_coalesced():
+    seen = []
+    p = Promise()
+    p.on_progress(seen.append, min_interval=0.2)
+
+    for i in range(100):
+        p.notify(i)
+
+    # Only the first value is delivered immediately, the latest one
+    # follows once the interval has passed.
+    assert_equals([0], seen)
+    time.sleep(0.4)
+    assert_equals([0, 99], seen)
+
+    # Wait out the interval after 99, which may have been late
+    time.sleep(0.3)
+    p.notify(100)
+    p.notify(101)
+    p.reject(Exception("Error"))
+    assert_equals([0, 99, 100, 101], seen)
+
+
+def test_spawn_progress():
+    from aplus import notify
+    from threading import Event
+
+    gate = Event()
+    seen = []
+
+    def job():
+        gate.wait()
+        notify("half")
+        return "done"
+
+    # Outside of a spawned job notify does nothing
+    notify("ignored")
+
+    p = spawn(job)
+    p.on_progress(seen.append)
+    gate.set()
+
+    try:
+        import gevent
+
+        gevent.sleep(0.5)
+    except ImportError:
+        time.sleep(0.5)
+
+    assert_equals("done", p.value)
+    assert_equals(["half"], seen)
+
+
+def test_lazy():
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return 5
+
+    p = Promise.lazy(compute)
+    assert p.isPending
+    assert_equals([], calls)
+
+    r = p.then(lambda v: v * 2)
+    assert_equals([1], calls)
+    assert_equals(10, r.value)
+    assert_equals(5, p.get())
+    assert_equals([1], calls)
+
+    # The function may return a promise, and is forced by get
+    inner = Promise()
+    q = Promise.lazy(lambda: inner)
+    inner.fulfill(7)
+    assert_equals(7, q.get())
+
+    # Exceptions reject the promise
+    e = Exception("Error")
+
+    def fail():
+        raise e
+
+    f = Promise.lazy(fail)
+    f.wait()
+    assert f.isRejected
+    assert_equals(e, f.reason)
+
+    # Adopting a lazy promise forces it
+    a = Promise()
+    a.fulfill(Promise.lazy(lambda: 3))
+    assert_equals(3, a.value)
+
+
+def test_lazy_aggregates():
+    calls = []
+
+    def make(v):
+        def compute():
+            calls.append(v)
+            return v
+        return Promise.lazy(compute)
+
+    l = listPromise(make(1), Promise.fulfilled(2), make(3))
+    d = dictPromise({"a": make("a"), "b": make("b")})
+    assert_equals([], calls)
+
+    assert_equals([1, 2, 3], l.get())
+    assert_equals([1, 3], calls)
+    assert_equals({"a": "a", "b": "b"}, d.get())
+    assert_equals([1, 3, "a", "b"], calls)
+
+
+def test_reduce():
+    from aplus import reduce
+
+    p1 = Promise()
+    p2 = Promise()
+    p3 = Promise()
+    order = []
+
+    def add(acc, v):
+        order.append(v)
+        return acc + v
+
+    r = reduce(add, iter([p1, p2, p3]), 0)
+    p3.fulfill(3)
+    p1.fulfill(1)
+    assert_equals([3, 1], order)
+    assert r.isPending
+    p2.fulfill(2)
+    assert_equals([3, 1, 2], order)
+    assert_equals(6, r.value)
+
+    # In order
+    p1 = Promise()
+    p2 = Promise()
+    order = []
+    r = reduce(add, [p1, p2, Promise.fulfilled(3)], 0, ordered=True)
+    p2.fulfill(2)
+    assert_equals([], order)
+    p1.fulfill(1)
+    assert_equals([1, 2, 3], order)
+    assert_equals(6, r.value)
+
+    # Nothing to fold
+    assert_equals("x", reduce(add, [], "x").value)
+
+
+def test_reduce_rejected():
+    from aplus import reduce
+
+    e = Exception("Error")
+    p1 = Promise()
+    r = reduce(lambda acc, v: acc + v, [p1, Promise.rejected(e)], 0)
+    assert r.isRejected
+    assert_equals(e, r.reason)
+
+    def fail(acc, v):
+        raise e
+
+    r = reduce(fail, [Promise.fulfilled(1)], 0)
+    assert r.isRejected
+    assert_equals(e, r.reason)
+
+
+def test_dispatcher():
+    from aplus import Dispatcher
+    import threading
+
+    wakeups = []
+    d = Dispatcher(wakeup=lambda: wakeups.append(1))
+    threads = []
+
+    p = Promise()
+    q = p.then(lambda v: threads.append(threading.current_thread()) or v + 1, on=d)
+    p.done(lambda v: threads.append(threading.current_thread()), on=d)
+    r = p.then(None, on=d)
+
+    t = Thread(target=p.fulfill, args=(1,))
+    t.start()
+    t.join()
+
+    # Nothing has run yet, and the three callbacks cost one wakeup
+    assert_equals([], threads)
+    assert q.isPending
+    assert_equals(1, len(wakeups))
+    assert d.wait(0)
+    assert_equals(3, d.pending)
+
+    assert_equals(3, d.run_pending())
+    assert_equals([threading.current_thread()] * 2, threads)
+    assert_equals(2, q.value)
+    assert_equals(1, r.value)
+    assert not d.wait(0)
+
+    # Rejections are delivered the same way
+    e = Exception("Error")
+    f = Promise.rejected(e).then(None, lambda r: "handled", on=d)
+    assert f.isPending
+    assert_equals(2, len(wakeups))
+    d.run_pending()
+    assert_equals("handled", f.value)
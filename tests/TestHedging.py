@@ -0,0 +1,106 @@
+# Tests for hedged requests
+
+from nose.tools import assert_equals, assert_raises
+from aplus import PriorityExecutor, hedge
+from aplus.hedging import _history, _histories, _MAX_HISTORIES
+import gc
+import itertools
+import time
+import weakref
+
+
+def test_hedge_slow_first_copy():
+    executor = PriorityExecutor(max_workers=4)
+    calls = itertools.count()
+
+    def backend():
+        n = next(calls)
+        time.sleep(1.0 if n == 0 else 0.05)
+        return n
+
+    start = time.monotonic()
+    p = hedge(backend, after=0.1, executor=executor)
+    assert_equals(1, p.get(2.0))
+    assert time.monotonic() - start < 0.5
+    executor.shutdown()
+
+
+def test_hedge_fast_first_copy():
+    executor = PriorityExecutor(max_workers=4)
+    calls = itertools.count()
+
+    def backend():
+        next(calls)
+        return "fast"
+
+    assert_equals("fast", hedge(backend, after=0.1, executor=executor).get(1.0))
+    time.sleep(0.2)
+
+    # No duplicate is started once a copy has succeeded
+    assert_equals(1, next(calls))
+    executor.shutdown()
+
+
+def test_hedge_failures():
+    executor = PriorityExecutor(max_workers=4)
+    calls = itertools.count()
+
+    def flaky():
+        if next(calls) == 0:
+            raise ValueError("First copy fails")
+        return "second"
+
+    # A failed copy is retried straight away rather than after the delay
+    start = time.monotonic()
+    assert_equals("second", hedge(flaky, after=5.0, executor=executor).get(1.0))
+    assert time.monotonic() - start < 1.0
+
+    def broken():
+        raise ValueError("Always fails")
+
+    p = hedge(broken, after=0.01, max_copies=3, executor=executor)
+    assert_raises(ValueError, p.get, 1.0)
+    executor.shutdown()
+
+
+def test_hedge_learned_delay():
+    executor = PriorityExecutor(max_workers=4)
+
+    def quick():
+        time.sleep(0.01)
+        return 1
+
+    for i in range(25):
+        hedge(quick, after="p90", key="quick", fallback=5.0, executor=executor).get(1.0)
+
+    history = _history("quick")
+    # Any second copies started once the delay was learned add to the
+    # history too.
+    assert len(history) >= 25
+    assert history.percentile(0.9) < 0.5
+    executor.shutdown()
+
+
+def test_hedge_history_bounded():
+    def make():
+        def fn():
+            return 1
+        return fn
+
+    fn = make()
+    history = _history(fn)
+    history.add(0.1)
+    assert _history(fn) is history
+
+    # A function's history goes when the function does
+    ref = weakref.ref(history)
+    del fn, history
+    gc.collect()
+    assert ref() is None
+
+    # Only the most recently used keyed histories are kept
+    first = _history(("bounded", 0))
+    for i in range(1, _MAX_HISTORIES + 1):
+        _history(("bounded", i))
+    assert len(_histories) <= _MAX_HISTORIES
+    assert _history(("bounded", 0)) is not first
@@ -0,0 +1,172 @@
+# Tests for promise based socket and pipe I/O
+
+from nose.tools import assert_equals, assert_is_instance
+from aplus import listPromise
+from aplus.io import EventLoop
+import os
+import socket
+import tempfile
+
+
+def test_socket_io():
+    loop = EventLoop()
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(5)
+
+    try:
+        accepted = loop.accept(server)
+        client = socket.socket()
+        assert_equals(None, loop.connect(client, server.getsockname()).get(5.0))
+        conn, address = accepted.get(5.0)
+
+        # Writes are queued in order, and whatever read_until reads
+        # past the delimiter is kept for the next read.
+        sent = listPromise([loop.send(client, b"hello\nwor"), loop.send(client, b"ld\nrest")])
+        assert_equals(b"hello\n", loop.read_until(conn, b"\n").get(5.0))
+        assert_equals(b"world\n", loop.read_until(conn, b"\n").get(5.0))
+        assert_equals([9, 7], sent.get(5.0))
+        assert_equals(b"rest", loop.recv(conn, 100).get(5.0))
+
+        # Many connections waiting at once
+        pending = [loop.recv(conn, 1) for i in range(3)]
+        assert pending[0].isPending
+        loop.send(client, b"abc")
+        assert_equals([b"a", b"b", b"c"], listPromise(pending).get(5.0))
+
+        loop.close(client).wait(5.0)
+        assert_equals(b"", loop.recv(conn, 100).get(5.0))
+        p = loop.read_until(conn, b"\n")
+        p.wait(5.0)
+        assert isinstance(p.reason, EOFError)
+        loop.close(conn).wait(5.0)
+    finally:
+        server.close()
+        loop.stop()
+
+
+def test_pipe_io():
+    loop = EventLoop()
+    r, w = os.pipe()
+
+    try:
+        line = loop.read_until(r, b"\n", max_bytes=100)
+        assert_equals(6, loop.send(w, b"line\nx").get(5.0))
+        assert_equals(b"line\n", line.get(5.0))
+
+        # Operations on an invalid file descriptor are rejected
+        invalid = loop.recv(w + 1000, 1)
+        invalid.wait(5.0)
+        assert invalid.isRejected
+
+        # Closing rejects the operations still waiting
+        pending = loop.read_until(r, b"\n")
+        pending.wait(0.1)
+        assert pending.isPending
+        assert_equals(None, loop.close(r).get(5.0))
+        pending.wait(5.0)
+        assert_is_instance(pending.reason, OSError)
+    finally:
+        loop.close(w).wait(5.0)
+        loop.stop()
+
+
+def test_connect_refused():
+    loop = EventLoop()
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    address = s.getsockname()
+    s.close()
+
+    client = socket.socket()
+    p = loop.connect(client, address)
+    p.wait(5.0)
+    assert isinstance(p.reason, ConnectionRefusedError)
+    client.close()
+    loop.stop()
+
+
+def test_run_process():
+    import sys
+
+    loop = EventLoop()
+    script = "import sys; sys.stdout.write(sys.stdin.read().upper()); sys.stderr.write('err'); sys.exit(3)"
+
+    try:
+        result = loop.run_process([sys.executable, "-c", script], input=b"hello")
+        assert_equals((3, b"HELLO", b"err"), result.get(10.0))
+
+        # Many children at once
+        script = "import sys; print(sys.argv[1])"
+        results = listPromise([loop.run_process([sys.executable, "-c", script, str(i)])
+                               for i in range(20)]).get(20.0)
+        assert_equals([(0, ("%d\n" % i).encode(), b"") for i in range(20)],
+                      [(r[0], r[1].replace(b"\r", b""), r[2]) for r in results])
+
+        # Streamed output
+        chunks = []
+        script = "import sys; sys.stdout.write('a' * 100000)"
+        result = loop.run_process([sys.executable, "-c", script],
+                                  on_output=lambda name, data: chunks.append((name, data)))
+        assert_equals((0, None, None), result.get(10.0))
+        assert_equals(100000, sum(len(data) for name, data in chunks))
+        assert_equals({"stdout"}, set(name for name, data in chunks))
+
+        p = loop.run_process(["/nonexistent/program"])
+        assert p.isRejected
+    finally:
+        loop.stop()
+
+
+def test_loop_survives_errors():
+    loop = EventLoop()
+    a, b = socket.socketpair()
+
+    try:
+        loop.call_soon(lambda: 1 / 0)
+        b.sendall(b"data")
+        assert_equals(b"data", loop.recv(a, 100).get(5.0))
+        assert loop._thread.is_alive()
+
+        # A file which the selector refuses to wait on rejects its
+        # operations rather than stopping the loop.
+        with tempfile.TemporaryFile() as f:
+            p = loop.submit(f, False, lambda channel: (False, None))
+            p.wait(5.0)
+            assert p.isRejected
+            assert_is_instance(p.reason, OSError)
+        b.sendall(b"more")
+        assert_equals(b"more", loop.recv(a, 100).get(5.0))
+        assert loop._thread.is_alive()
+    finally:
+        a.close()
+        b.close()
+        loop.stop()
+
+
+def test_reused_fd():
+    loop = EventLoop()
+    a1, b1 = socket.socketpair()
+    a2 = b2 = None
+
+    try:
+        b1.sendall(b"line\nSECRET")
+        assert_equals(b"line\n", loop.read_until(a1, b"\n").get(5.0))
+
+        # Closing the socket directly leaves the buffered data behind,
+        # which must not be read from a new socket with the same fd.
+        fd = a1.fileno()
+        a1.close()
+        a2, b2 = socket.socketpair()
+        if a2.fileno() != fd:
+            os.dup2(a2.fileno(), fd)
+            a2.close()
+            a2 = socket.socket(fileno=fd)
+
+        b2.sendall(b"fresh")
+        assert_equals(b"fresh", loop.recv(a2, 100).get(5.0))
+    finally:
+        for s in (b1, a2, b2):
+            if s is not None:
+                s.close()
+        loop.stop()
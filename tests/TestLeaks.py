@@ -0,0 +1,81 @@
+# Tests for the pending promise leak tracker
+
+from nose.tools import assert_equals, assert_raises
+from aplus import LeakTracker, Promise
+import gc
+import io
+
+
+def make_pending():
+    p = Promise()
+    p.then(lambda v: v)
+    p.then(lambda v: v)
+    return p
+
+
+def test_leak_tracker():
+    with LeakTracker(stacks=True) as tracker:
+        kept = [make_pending() for i in range(3)]
+        settled = Promise()
+        settled.fulfill(1)
+        dropped = make_pending()
+        del dropped
+        gc.collect()
+
+    # Promises created once stopped are ignored
+    Promise()
+
+    report = tracker.report()
+    # Each kept promise and the two chained from it
+    assert_equals(9, report["pending"])
+    assert_equals(12, report["callbacks"])
+    assert_equals(9, report["ages"][1.0])
+
+    sites = report["sites"]
+    created = [site for site in sites if "make_pending" in site]
+    # One site for the promise and one for each call to then
+    assert_equals(3, len(created))
+    assert_equals([3, 3, 3], [sites[site]["count"] for site in created])
+    assert_equals([0, 0, 12], sorted(sites[site]["callbacks"] for site in created))
+
+    oldest = tracker.oldest(2)
+    assert_equals(2, len(oldest))
+    assert oldest[0]["promise"] is kept[0]
+    assert oldest[0]["age"] >= oldest[1]["age"]
+    assert any("test_leak_tracker" in frame.name for frame in oldest[0]["stack"])
+
+    out = io.StringIO()
+    tracker.dump(1, file=out)
+    assert "Pending for" in out.getvalue()
+    assert "make_pending" in out.getvalue()
+
+    # Settling removes them
+    for p in kept:
+        p.fulfill(1)
+    assert_equals(0, tracker.pending)
+
+
+def test_leak_tracker_limit():
+    with LeakTracker(max_tracked=2) as tracker:
+        kept = [Promise() for i in range(5)]
+        assert_raises(ValueError, LeakTracker().start)
+
+    assert_equals(2, tracker.pending)
+    assert_equals(3, tracker.untracked)
+
+
+def test_leak_tracker_adopted():
+    with LeakTracker(max_tracked=3) as tracker:
+        inner = Promise()
+        followers = [Promise() for i in range(2)]
+        for p in followers:
+            p.fulfill(inner)
+        inner.fulfill(1)
+
+        # Promises settled by adoption stop being tracked too
+        assert_equals([1, 1], [p.value for p in followers])
+        assert_equals(0, len(tracker._records))
+        kept = Promise()
+
+    assert_equals(1, tracker.pending)
+    assert_equals(0, tracker.untracked)
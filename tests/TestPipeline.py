@@ -0,0 +1,108 @@
+# Tests for multi-stage pipelines with bounded queues
+
+from nose.tools import assert_equals, assert_raises
+from aplus import Pipeline, Promise, listPromise
+from threading import Event, Thread
+import time
+
+
+def test_pipeline():
+    pipeline = Pipeline()
+    pipeline.stage(lambda x: x + 1, concurrency=3)
+    pipeline.stage(lambda x: Promise.fulfilled(x * 2), name="double")
+    pipeline.stage(lambda x: x - 1, concurrency=2)
+
+    results = [pipeline.submit(i) for i in range(20)]
+    pipeline.close().wait(5.0)
+
+    assert_equals([(i + 1) * 2 - 1 for i in range(20)],
+                  listPromise(results).get(1.0))
+
+    metrics = pipeline.metrics()
+    assert_equals(3, len(metrics))
+    assert_equals("double", metrics[1]["name"])
+    for m in metrics:
+        assert_equals(20, m["processed"])
+        assert_equals(0, m["queue_depth"])
+        assert_equals(0, m["active"])
+
+    assert_raises(ValueError, pipeline.submit, 1)
+
+
+def test_pipeline_errors():
+    def check(x):
+        if x % 2:
+            raise ValueError("Odd")
+        return x
+
+    pipeline = Pipeline().stage(check).stage(lambda x: x * 10)
+
+    p1 = pipeline.submit(2)
+    p2 = pipeline.submit(3)
+    pipeline.close().wait(5.0)
+
+    assert_equals(20, p1.get(1.0))
+    assert_raises(ValueError, p2.get, 1.0)
+    assert_equals(1, pipeline.metrics()[0]["failed"])
+    assert_equals(1, pipeline.metrics()[1]["processed"])
+
+
+def test_pipeline_backpressure():
+    release = Event()
+    submitted = []
+
+    def sink(x):
+        release.wait()
+        return x
+
+    pipeline = Pipeline()
+    pipeline.stage(lambda x: x, queue_size=1)
+    pipeline.stage(sink, queue_size=1)
+
+    def producer():
+        for i in range(10):
+            submitted.append(pipeline.submit(i))
+
+    t = Thread(target=producer)
+    t.daemon = True
+    t.start()
+    time.sleep(0.5)
+
+    # One item in the sink, one in each queue and one blocked in
+    # the first stage's worker, so the producer has been throttled.
+    assert len(submitted) < 10
+    metrics = pipeline.metrics()
+    assert_equals(1, metrics[0]["queue_depth"])
+    assert_equals(1, metrics[1]["queue_depth"])
+    assert_equals(1, metrics[1]["active"])
+
+    release.set()
+    t.join(5.0)
+    pipeline.close().wait(5.0)
+    assert_equals(list(range(10)), listPromise(submitted).get(1.0))
+
+
+def test_pipeline_close_while_submitting():
+    for trial in range(20):
+        pipeline = Pipeline().stage(lambda x: x, concurrency=2)
+        accepted = []
+
+        def producer():
+            for i in range(50):
+                try:
+                    accepted.append(pipeline.submit(i))
+                except ValueError:
+                    return
+
+        threads = [Thread(target=producer) for i in range(3)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        pipeline.close().wait(5.0)
+        for t in threads:
+            t.join(5.0)
+
+        # Every item accepted before close is processed
+        results = listPromise(accepted)
+        results.wait(5.0)
+        assert results.isFulfilled
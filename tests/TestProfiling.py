@@ -0,0 +1,48 @@
+# Tests for profiling of then chains
+
+from nose.tools import assert_equals, assert_raises
+from aplus import ChainProfiler, Promise
+import time
+
+
+def slow_handler(v):
+    time.sleep(0.05)
+    return v + 1
+
+
+def failure_handler(r):
+    return "recovered"
+
+
+def test_chain_profiler():
+    with ChainProfiler() as profiler:
+        for i in range(5):
+            p = Promise()
+            chained = p.then(slow_handler).then(None, failure_handler)
+            time.sleep(0.02)
+            p.fulfill(i)
+            assert_equals(i + 1, chained.value)
+            assert chained._parent() is not None
+
+        p = Promise()
+        p.then(lambda v: v).then(None, failure_handler)
+        p.reject(Exception("Error"))
+
+    report = profiler.report()
+    slow = report[__name__ + ".slow_handler"]
+    assert_equals(5, slow["count"])
+    assert slow["run"]["p50"] >= 0.04
+    assert slow["wait"]["p50"] >= 0.015
+    assert slow["delay"]["max"] < 0.05
+
+    # Handlers are only recorded when they are actually called
+    assert_equals(1, report[__name__ + ".failure_handler"]["count"])
+
+    # Nothing is recorded once the profiler has stopped
+    Promise.fulfilled(1).then(slow_handler)
+    assert_equals(5, profiler.report()[__name__ + ".slow_handler"]["count"])
+
+
+def test_single_profiler():
+    with ChainProfiler():
+        assert_raises(ValueError, ChainProfiler().start)
@@ -0,0 +1,183 @@
+# Tests for promises settled from other processes
+
+from nose.tools import assert_equals, assert_is_instance, assert_raises
+from aplus import (Promise, RemoteError, RemotePromise, RemoteReceiver,
+                   RemoteSender, listPromise)
+from aplus.remote import _MESSAGE
+from multiprocessing import Pipe, Process
+import json
+import pickle
+import socket
+
+
+class JsonSerializer:
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data.decode("utf-8"))
+
+
+class CountingChannel:
+    def __init__(self, conn):
+        self.conn = conn
+        self.frames = 0
+
+    def send_bytes(self, data):
+        self.frames += 1
+        self.conn.send_bytes(data)
+
+    def close(self):
+        self.conn.close()
+
+
+def square_worker(conn, ids):
+    sender = RemoteSender(conn)
+    for i, promise_id in enumerate(ids):
+        if i == 0:
+            sender.reject(promise_id, ValueError("Bad input"))
+        else:
+            sender.fulfill(promise_id, i * i)
+    sender.close()
+
+
+def test_remote_process():
+    local, remote = Pipe()
+    receiver = RemoteReceiver(local)
+    promises = [receiver.promise() for i in range(10)]
+    assert_is_instance(promises[0], RemotePromise)
+
+    worker = Process(target=square_worker, args=(remote, [p.id for p in promises]))
+    worker.start()
+    remote.close()
+
+    squares = listPromise(promises[1:]).then(sum)
+    assert_equals(sum(i * i for i in range(1, 10)), squares.get(5.0))
+    assert_raises(ValueError, promises[0].get, 1.0)
+    worker.join(5.0)
+    receiver.close()
+
+
+def test_remote_socket_batching():
+    a, b = socket.socketpair()
+    receiver = RemoteReceiver(a, serializer=JsonSerializer)
+    sender = RemoteSender(b, serializer=JsonSerializer, batch_size=3, flush_interval=60)
+
+    promises = [receiver.promise() for i in range(4)]
+    for p in promises[:3]:
+        sender.fulfill(p.id, [p.id])
+
+    assert_equals([[0], [1], [2]], listPromise(promises[:3]).get(5.0))
+
+    # The last result waits for an explicit flush
+    sender.fulfill(promises[3].id, "last")
+    promises[3].wait(0.2)
+    assert promises[3].isPending
+    sender.flush()
+    assert_equals("last", promises[3].get(5.0))
+
+    sender.close()
+    receiver.close()
+
+
+def test_remote_flush_interval():
+    local, remote = Pipe()
+    channel = CountingChannel(remote)
+    receiver = RemoteReceiver(local)
+    sender = RemoteSender(channel, flush_interval=0.05)
+
+    promises = [receiver.promise() for i in range(10)]
+    for p in promises:
+        sender.settle(p.id, Promise.fulfilled(p.id))
+
+    assert_equals(list(range(10)), listPromise(promises).get(5.0))
+    assert_equals(1, channel.frames)
+
+    sender.close()
+    receiver.close()
+
+
+def test_remote_unserializable_and_lost():
+    local, remote = Pipe()
+    receiver = RemoteReceiver(local)
+    sender = RemoteSender(remote)
+
+    p1 = receiver.promise()
+    p2 = receiver.promise()
+    p3 = receiver.promise()
+    sender.fulfill(p1.id, lambda: None)
+    sender.fulfill(p2.id, 2)
+    sender.flush()
+
+    assert_equals(2, p2.get(5.0))
+    assert_raises(RemoteError, p1.get, 5.0)
+
+    sender.close()
+    assert_raises(RemoteError, p3.get, 5.0)
+    assert_raises(RemoteError, receiver.promise)
+
+
+class CodedError(Exception):
+    """Pickles, but can't be unpickled, since it needs two arguments."""
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+def test_remote_unreadable_results():
+    local, remote = Pipe()
+    receiver = RemoteReceiver(local)
+    sender = RemoteSender(remote)
+
+    # A reason which can't be rebuilt is sent as a description
+    p1 = receiver.promise()
+    p2 = receiver.promise()
+    sender.reject(p1.id, CodedError(1, "x"))
+    sender.fulfill(p2.id, 2)
+    sender.flush()
+    assert_equals(2, p2.get(5.0))
+    p1.wait(5.0)
+    assert_is_instance(p1.reason, RemoteError)
+    assert_equals("CodedError: x", str(p1.reason))
+
+    # A payload the receiver can't read only rejects its own promise
+    p3 = receiver.promise()
+    p4 = receiver.promise()
+    data = pickle.dumps(4)
+    remote.send_bytes(_MESSAGE.pack(p3.id, True, 3) + b"bad"
+                      + _MESSAGE.pack(p4.id, True, len(data)) + data)
+    assert_equals(4, p4.get(5.0))
+    p3.wait(5.0)
+    assert_is_instance(p3.reason, RemoteError)
+
+    p5 = receiver.promise()
+    sender.fulfill(p5.id, 5)
+    sender.flush()
+    assert_equals(5, p5.get(5.0))
+
+    sender.close()
+    receiver.close()
+
+
+def test_remote_json_rejection():
+    a, b = socket.socketpair()
+    receiver = RemoteReceiver(a, serializer=JsonSerializer)
+    sender = RemoteSender(b, serializer=JsonSerializer, flush_interval=0.01)
+
+    p1 = receiver.promise()
+    p2 = receiver.promise()
+    sender.reject(p1.id, ValueError("bad value"))
+    p1.wait(5.0)
+    assert_is_instance(p1.reason, RemoteError)
+    assert_equals("ValueError: bad value", str(p1.reason))
+
+    # The sender keeps working afterwards
+    sender.fulfill(p2.id, "ok")
+    assert_equals("ok", p2.get(5.0))
+    assert sender._flusher.is_alive()
+
+    sender.close()
+    receiver.close()
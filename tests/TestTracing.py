@@ -0,0 +1,82 @@
+# Tests for recording Chrome traces of promise causality
+
+from nose.tools import assert_equals, assert_raises
+from aplus import Promise, TraceRecorder, listPromise, spawn
+from threading import Thread
+import io
+import json
+import time
+
+
+def double(v):
+    return v * 2
+
+
+def test_trace_recorder():
+    with TraceRecorder() as recorder:
+        p1 = Promise()
+        p2 = Promise()
+        chained = p1.then(double)
+        both = listPromise(chained, p2)
+        s = spawn(lambda: 3)
+
+        t = Thread(target=p1.fulfill, args=(5,), name="fulfiller")
+        t.start()
+        t.join()
+        p2.fulfill(1)
+
+        try:
+            import gevent
+
+            gevent.sleep(0.1)
+        except ImportError:
+            time.sleep(0.1)
+
+    assert_equals([10, 1], both.value)
+    assert_equals(3, s.value)
+
+    out = io.StringIO()
+    recorder.export(out)
+    events = json.loads(out.getvalue())["traceEvents"]
+
+    names = [e["name"] for e in events]
+    assert "create" in names
+    assert "fulfill" in names
+    assert "then double" in names
+    assert "listPromise" in names
+    assert any(n.startswith("spawn ") for n in names)
+    assert any(n.startswith("run ") for n in names)
+
+    threads = [e["args"]["name"] for e in events if e["ph"] == "M"]
+    assert "fulfiller" in threads
+
+    # The handler of the chained promise ran on the fulfilling thread,
+    # with an arrow from the settlement of its parent.
+    handler = [e for e in events if e["name"] == "then double"][0]
+    settle = [e for e in events if e["name"] == "fulfill" and
+              e["args"]["promise"] == handler["args"]["parent"]][0]
+    assert_equals(settle["tid"], handler["tid"])
+
+    starts = dict((e["id"], e) for e in events if e["ph"] == "s")
+    finishes = dict((e["id"], e) for e in events if e["ph"] == "f")
+    assert_equals(sorted(starts), sorted(finishes))
+    assert any(starts[i]["ts"] == settle["ts"] and finishes[i]["ts"] == handler["ts"]
+               for i in starts)
+
+
+def test_trace_ring_buffer():
+    with TraceRecorder(capacity=10) as recorder:
+        for i in range(100):
+            Promise().then(double).fulfill(i)
+
+    events = [e for e in recorder.events() if e["ph"] != "M"]
+    assert_equals(10, len(events))
+
+    # Nothing is recorded once the recorder has stopped
+    Promise.fulfilled(1)
+    assert_equals(10, len([e for e in recorder.events() if e["ph"] != "M"]))
+
+
+def test_single_recorder():
+    with TraceRecorder():
+        assert_raises(ValueError, TraceRecorder().start)